@@ -8,8 +8,10 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_wtf.csrf import CSRFProtect
 from flask_debugtoolbar import DebugToolbarExtension
+from app.utils.password import PasswordHasher
+from app.utils.metrics import FlaskMetrics
 
-import os
+import os, time
 
 
 ###########################################################################
@@ -36,6 +38,7 @@ app.config.from_object(os.environ['APP_CONFIG'])
 ###########################################################################
 # Extensions
 #
+metrics = FlaskMetrics(app)  # first, to time the other before_request functions
 login_manager = LoginManager()
 login_manager.init_app(app)
 bcrypt = Bcrypt(app)
@@ -44,6 +47,7 @@ mail = Mail(app)
 moment = Moment(app)
 toolbar = DebugToolbarExtension(app)
 db = SQLAlchemy(app)
+hasher = PasswordHasher(app)
 
 
 ###########################################################################
@@ -69,7 +73,8 @@ login_manager.needs_refresh_message_category = "info"
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(UUID(id))
+    # Flask-Login keeps the user for the rest of the request
+    return User.get_cached(UUID(id))
 
 
 ###########################################################################
@@ -82,8 +87,17 @@ def home():
 
 @app.before_request
 def before_request():
-    session.modified  = True
-    session.permanent = True
+    if request.endpoint and request.endpoint.split('.')[-1] in ('static', 'metrics'):
+        return
+
+    if not session.permanent:
+        session.permanent = True
+
+    # reissue the session cookie only when it gets close to its expiration
+    now = int(time.time())
+    lifetime = app.permanent_session_lifetime - app.config['SESSION_REFRESH_WITHIN']
+    if now - session.get('_issued_on', 0) > lifetime.total_seconds():
+        session['_issued_on'] = now
 
 
 ###########################################################################
@@ -1,29 +1,82 @@
 from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
 
-from bokeh.application import Application
-from bokeh.application.handlers import ScriptHandler, FunctionHandler
 from bokeh.server.server import Server
 
+import multiprocessing
 import os
+import sys
+import time
 
 MODELS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')
 
+# app scripts import their helper modules from MODELS_PATH by plain module
+# names, so the shared hub must be imported the same way to be the same module
+sys.path.insert(0, MODELS_PATH)
+import mqtt_hub
+import metrics
+import lifecycle
+import g
 
-def _bokeh_init():
+
+class MetricsHandler(RequestHandler):
+    """Metrics of this Bokeh server process, see models/metrics.py."""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.REGISTRY.render())
+
+
+def _bokeh_init(port=g.BOKEH_PORT):
     io_loop = IOLoop.current()
 
+    # one mosquitto connection for all sessions of this process
+    mqtt_hub.start_hub()
+
     server = Server(
         {
-            '/_measure':   Application(ScriptHandler(filename='{}/palmar_grip.py'.format(MODELS_PATH))),
-            '/_calibre':   Application(ScriptHandler(filename='{}/calibration.py'.format(MODELS_PATH))),
-            '/_plot'   :   Application(ScriptHandler(filename='{}/plot_measure.py'.format(MODELS_PATH))),
+            '/_measure':   lifecycle.application('{}/palmar_grip.py'.format(MODELS_PATH)),
+            '/_calibre':   lifecycle.application('{}/calibration.py'.format(MODELS_PATH)),
+            '/_plot'   :   lifecycle.application('{}/plot_measure.py'.format(MODELS_PATH)),
         },
         io_loop=io_loop,
-        allow_websocket_origin=["localhost:5000"]
+        port=port,
+        allow_websocket_origin=["localhost:5000"],
+        extra_patterns=[('/metrics', MetricsHandler)]
     )
     server.start()
     io_loop.start()
 
 
+def _bokeh_workers(workers=g.BOKEH_WORKERS, port=g.BOKEH_PORT):
+    """Run 'workers' server processes, on ports port to port + workers - 1,
+    so the sessions are spread over the CPUs. Each process has its own
+    IOLoop and mosquitto connection. A Bokeh session lives in one process,
+    so the Flask views send all the sessions of a user to the same port
+    (views.bokeh_url_for). A worker that dies is restarted on its port.
+    """
+    if workers <= 1:
+        return _bokeh_init(port)
+
+    def _start(index):
+        process = multiprocessing.Process(target=_bokeh_init, args=(port + index,),
+                                          name='bokeh_worker_%d' % index)
+        process.start()
+        return process
+
+    processes = [_start(index) for index in range(workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    processes[index] = _start(index)
+
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
 if __name__ == '__main__':
-    _bokeh_init()
+    _bokeh_workers()
@@ -0,0 +1,493 @@
+# Synthetic load for the '/_measure' app: emulated dynamometers streaming to
+# headless Bokeh sessions, all in one process.
+#
+# Each emulated device answers the commands published on devicectrl/<id> on
+# devicectrlcb/<id>, follows the period published on period/<id> and, while
+# streaming, publishes measure/<id> payloads in the "[t,f,t,f,...])" text
+# format of the firmware. Sessions run palmar_grip.py with no browser: the
+# bench selects a device, connects and starts streaming as a user would, and
+# the document changes are serialized as they would be for a websocket.
+#
+# For each session the bench reports the latency from the publication of a
+# payload to the source.stream() of its last sample, the samples published
+# but never streamed, and the size of the document patches. CPU and memory
+# are those of the whole process (server, devices and broker stub).
+#
+# Usage, with a bokeh token of a user of some calibrated devices:
+#   $ python app/_bokeh/bench.py --token <token> [--broker localhost:1883]
+# or, with a seeded user and the Flask API called in-process:
+#   $ python manage.py bench
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from bokeh.server.application_context import ApplicationContext
+from bokeh.server.protocol import Protocol
+from bokeh.util.session_id import generate_session_id
+
+import argparse
+import collections
+import json
+import numpy
+import os
+import resource
+import sys
+import threading
+import time
+
+MODELS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')
+
+# same modules as the app scripts, see _bokeh.py
+sys.path.insert(0, MODELS_PATH)
+import g
+import api
+import util
+import mqtt_hub
+import lifecycle
+
+try:
+    # Python 2.7
+    from Queue import Queue
+except ImportError:
+    # Python 3
+    from queue import Queue
+
+
+class BenchError(Exception):
+    pass
+
+
+##############################################################################
+# Broker stub
+
+LoopbackMessage = collections.namedtuple('LoopbackMessage', 'topic payload')
+
+
+class LoopbackClient(object):
+    """Embedded broker stub standing in for the hub's paho client: the
+    messages published through it are delivered to the hub's subscribers
+    from a single network thread, as paho does.
+
+    Args:
+        + hub : MqttHub using this client.
+    """
+
+    def __init__(self, hub):
+        self.hub     = hub
+        self._queue  = Queue()
+        self._thread = None
+
+    def connect_async(self, **kwargs):
+        pass
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._loop, name='loopback-broker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def loop_stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topics):
+        pass
+
+    def unsubscribe(self, topics):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._queue.put(LoopbackMessage(topic, payload))
+
+    def _loop(self):
+        self.hub._on_connect(self, None, None, 0)
+
+        msg = self._queue.get()
+        while msg is not None:
+            self.hub._on_message(self, None, msg)
+            msg = self._queue.get()
+
+        self.hub._on_disconnect(self, None, 0)
+
+
+class LoopbackHub(mqtt_hub.MqttHub):
+    """MqttHub on the embedded broker stub, for benches with no mosquitto."""
+
+    def __init__(self, **kwargs):
+        super(LoopbackHub, self).__init__(**kwargs)
+        self._client = LoopbackClient(self)
+
+
+##############################################################################
+# Devices
+
+class EmulatedDevice(object):
+    """Dynamometer answering the sessions' commands as the firmware does.
+
+    Device ticks (us) start at 0 with the first streamed sample, which the
+    session's decoder rebases to t = 0 s: a sample at t was taken at
+    't0 + t' in wall clock time.
+
+    Args:
+        + hub       : MqttHub the device publishes and subscribes through.
+        + device_id : device code, as in the mosquitto topics.
+        + period    : sampling period (ms) until a session sends one.
+    """
+
+    def __init__(self, hub, device_id, period=g.DATA_FREQ_VAL):
+        self.hub       = hub
+        self.device_id = device_id
+        self.period    = period
+
+        self.t_ctrl    = str("devicectrl/%s" % device_id)
+        self.t_ctrl_cb = str("devicectrlcb/%s" % device_id)
+        self.t_period  = str("period/%s" % device_id)
+        self.t_measure = str("measure/%s" % device_id)
+
+        self.ctrl_id   = None   # controlling session
+        self.streaming = False
+        self.t0        = None   # wall clock time (s) of tick 0
+        self.tick      = 0      # next sample (us)
+        self.published = 0      # samples
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.hub.subscribe([self.t_ctrl, self.t_period], self.on_message)
+
+    def stop(self):
+        self.hub.unsubscribe([self.t_ctrl, self.t_period], self.on_message)
+
+    def on_message(self, msg):
+        try:
+            data = json.loads(msg.payload)
+        except ValueError:
+            return
+
+        if msg.topic == self.t_period:
+            with self._lock:
+                if data.get('ctrl_id') == self.ctrl_id:
+                    self.period = int(data['period'])
+            return
+
+        ctrl_id = data.get('ctrl_id')
+        command = data.get('command')
+        reply   = None
+
+        with self._lock:
+            if command == 'conn':
+                if self.ctrl_id is None:
+                    self.ctrl_id = ctrl_id
+                    reply = 'successfully_connected'
+                elif self.ctrl_id == ctrl_id:
+                    reply = 'already_connected'
+                else:
+                    reply = 'no_control_allowed'
+
+            elif ctrl_id != self.ctrl_id:
+                reply = 'no_control_allowed'
+
+            elif command == 'toggle':
+                self.streaming = not self.streaming
+                if self.streaming and self.t0 is None:
+                    self.t0   = time.time()
+                    self.tick = 0
+
+            elif command in ('disc', 'unsub'):
+                self.ctrl_id   = None
+                self.streaming = False
+                reply = 'successfully_disconnected' if command == 'disc' else 'ok_to_unsubscribe'
+
+        if reply:
+            self.hub.publish(self.t_ctrl_cb, reply, qos=1)
+
+    def publish_due(self, now):
+        """Publish the samples taken until 'now' (s) in one payload.
+
+        Return:
+            the number of samples published.
+        """
+
+        with self._lock:
+            if not self.streaming:
+                return 0
+
+            step  = self.period * 1000
+            ticks = numpy.arange(self.tick, int((now - self.t0) * 1e6) + 1, step)
+            if not ticks.size:
+                return 0
+
+            self.tick       = int(ticks[-1]) + step
+            self.published += ticks.size
+
+        # raw force: a slow squeeze around mid scale
+        force  = (2048 + 1500 * numpy.sin(ticks * (2 * numpy.pi / 4e6))).astype(numpy.int64)
+        values = numpy.column_stack((ticks, force)).ravel()
+
+        self.hub.publish(self.t_measure, "([%s])" % ",".join(map(str, values)), qos=0)
+        return ticks.size
+
+
+##############################################################################
+# Sessions
+
+class PatchSink(object):
+    """Connection of a headless session: serializes the document patches as
+    a websocket connection would, and only counts them.
+    """
+
+    protocol = Protocol("1.0")
+
+    def __init__(self):
+        self.patches = 0
+        self.bytes   = 0
+
+    def send_patch_document(self, event):
+        msg = self.protocol.create('PATCH-DOC', [event])
+
+        self.patches += 1
+        self.bytes   += len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json)
+
+        future = gen.Future()
+        future.set_result(None)
+        return future
+
+
+class _Request(object):
+    def __init__(self, **arguments):
+        self.arguments = dict((key, [value]) for key, value in arguments.items())
+
+
+class SessionStats(object):
+
+    def __init__(self, session, device):
+        self.session   = session
+        self.device    = device
+        self.sink      = PatchSink()
+        self.streamed  = 0   # samples
+        self.latencies = []  # s
+
+    def observe(self, data):
+        t = data['t']
+        self.streamed += len(t)
+        self.latencies.append(time.time() - self.device.t0 - t[-1])
+
+
+class Bench(object):
+    """Emulated devices streaming to headless '/_measure' sessions.
+
+    Args:
+        + token    : bokeh token of a user of the devices to emulate.
+        + sessions : number of sessions, each one streaming from its own
+                     device of the user, or None for one per device.
+        + seconds  : streaming time (s).
+        + batch    : time (ms) between two payloads of a device.
+        + broker   : "host:port" of a mosquitto broker, or None to use the
+                     embedded broker stub.
+    """
+
+    APP_PATH = os.path.join(MODELS_PATH, 'palmar_grip.py')
+
+    def __init__(self, token, sessions=None, seconds=10., batch=50, broker=None):
+        self.token    = token
+        self.sessions = sessions
+        self.seconds  = seconds
+        self.batch    = batch
+        self.broker   = broker
+
+        self.stats   = collections.OrderedDict()  # document -> SessionStats
+        self.devices = []
+        self.usage   = None
+
+        self._stop = threading.Event()
+
+    def run(self):
+        """Run the bench on a new IOLoop.
+
+        Return:
+            the report, see report().
+        """
+
+        if self.broker:
+            host, _, port = self.broker.partition(':')
+            hub         = mqtt_hub.start_hub(host=host, port=int(port or g.MQTT_PORT))
+            devices_hub = mqtt_hub.MqttHub(host=host, port=int(port or g.MQTT_PORT),
+                                           client_id="bench_devices_%d" % os.getpid())
+            devices_hub.start()
+        else:
+            hub = devices_hub = mqtt_hub.start_hub(LoopbackHub)
+
+        calibrations = api.get_client().get_calibrations(self.token)
+        codes = calibrations['d_code'][:self.sessions]
+
+        self.devices = [EmulatedDevice(devices_hub, code) for code in codes]
+        for device in self.devices:
+            device.start()
+
+        io_loop = IOLoop()
+        io_loop.make_current()
+        try:
+            io_loop.run_sync(lambda: self._run(io_loop, hub))
+        finally:
+            for device in self.devices:
+                device.stop()
+            if devices_hub is not hub:
+                devices_hub.stop()
+            io_loop.close()
+
+        return self.report()
+
+    @gen.coroutine
+    def _run(self, io_loop, hub):
+        yield self._wait(lambda: hub.connected, "no connection to the broker.")
+
+        context = ApplicationContext(lifecycle.application(self.APP_PATH), io_loop=io_loop)
+
+        for device in self.devices:
+            # the app script exits if the API rejects the token
+            try:
+                session = yield context.create_session_if_needed(
+                    generate_session_id(), _Request(token=self.token))
+            except SystemExit:
+                session = None
+
+            if session is None or session.document.get_model_by_name('device_slc') is None:
+                raise BenchError("session not initialized, check the token.")
+
+            stats = SessionStats(session, device)
+            session.subscribe(stats.sink)
+            self.stats[session.document] = stats
+
+        util.StreamScheduler.observers.append(self.observe)
+        try:
+            yield [self._start_streaming(stats) for stats in self.stats.values()]
+
+            publisher = threading.Thread(target=self._publish, name='bench-devices')
+            publisher.start()
+
+            usage   = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.time()
+
+            yield gen.sleep(self.seconds)
+
+            self._stop.set()
+            publisher.join()
+
+            # let the last payloads through the broker and the schedulers
+            yield gen.sleep(2e-3 * (g.STREAM_LATENCY + self.batch) + 0.5)
+
+            self.usage = (usage, resource.getrusage(resource.RUSAGE_SELF), time.time() - started)
+        finally:
+            util.StreamScheduler.observers.remove(self.observe)
+
+        for stats in self.stats.values():
+            yield stats.session.with_document_locked(self._update, stats, 'stream_data_btn', active=True)
+            yield stats.session.with_document_locked(self._update, stats, 'device_conn_btn', active=True)
+            stats.session.unsubscribe(stats.sink)
+
+        # destroy the sessions, as the server does once their tabs are closed
+        for stats in self.stats.values():
+            stats.session.request_expiration()
+        yield context.cleanup_sessions(0)
+
+    @gen.coroutine
+    def _wait(self, condition, error, timeout=10.):
+        end = time.time() + timeout
+        while not condition():
+            if time.time() > end:
+                raise BenchError(error)
+            yield gen.sleep(0.05)
+
+    @staticmethod
+    def _update(stats, name, **kwargs):
+        stats.session.document.get_model_by_name(name).update(**kwargs)
+
+    @gen.coroutine
+    def _start_streaming(self, stats):
+        """Select the session's device, connect to it and start streaming,
+        as the widgets of the app would.
+        """
+
+        session = stats.session
+        device  = stats.device
+
+        yield session.with_document_locked(self._update, stats, 'device_slc', value=device.device_id)
+        yield session.with_document_locked(self._update, stats, 'device_conn_btn', active=False)
+        yield self._wait(lambda: session.document.get_model_by_name('conn_status').value,
+                         "device %s did not connect." % device.device_id)
+
+        yield session.with_document_locked(self._update, stats, 'stream_data_btn', active=False)
+        yield self._wait(lambda: device.streaming,
+                         "device %s did not start streaming." % device.device_id)
+
+    def _publish(self):
+        while not self._stop.wait(1e-3 * self.batch):
+            now = time.time()
+            for device in self.devices:
+                device.publish_due(now)
+
+    def observe(self, scheduler, data):
+        stats = self.stats.get(scheduler.doc)
+        if stats is not None:
+            stats.observe(data)
+
+    def report(self):
+        """Per session and overall latencies (ms), dropped samples and patch
+        sizes, then the CPU and memory use of the process.
+        """
+
+        lines = ["%-24s %9s %9s %8s %8s %8s %8s %8s %10s" % ("device", "published",
+                 "streamed", "dropped", "p50 ms", "p95 ms", "max ms", "patches", "KiB")]
+
+        def line(name, published, streamed, latencies, patches, size):
+            latencies = numpy.array(latencies or [numpy.nan]) * 1e3
+            return "%-24s %9d %9d %8d %8.1f %8.1f %8.1f %8d %10.1f" % (
+                name, published, streamed, published - streamed,
+                numpy.percentile(latencies, 50), numpy.percentile(latencies, 95),
+                latencies.max(), patches, size / 1024.)
+
+        for stats in self.stats.values():
+            lines.append(line(stats.device.device_id, stats.device.published, stats.streamed,
+                              stats.latencies, stats.sink.patches, stats.sink.bytes))
+
+        stats = list(self.stats.values())
+        lines.append(line("total",
+            sum(s.device.published for s in stats),
+            sum(s.streamed for s in stats),
+            sum((s.latencies for s in stats), []),
+            sum(s.sink.patches for s in stats),
+            sum(s.sink.bytes for s in stats)))
+
+        if self.usage:
+            before, after, elapsed = self.usage
+            user = after.ru_utime - before.ru_utime
+            syst = after.ru_stime - before.ru_stime
+            lines.append("\ncpu: %.2f s user, %.2f s system in %.1f s (%.0f%% of a core), "
+                         "max rss: %.1f MiB" % (user, syst, elapsed,
+                         100 * (user + syst) / elapsed, after.ru_maxrss / 1024.))
+
+        return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulated devices streaming to "
+                                     "headless '/_measure' sessions.")
+    parser.add_argument('--token', required=True,
+                        help="bokeh token of a user of the devices to emulate")
+    parser.add_argument('--sessions', type=int, default=None,
+                        help="number of sessions (default: one per device of the user)")
+    parser.add_argument('--seconds', type=float, default=10.,
+                        help="streaming time (s)")
+    parser.add_argument('--batch', type=int, default=50,
+                        help="time between two payloads of a device (ms)")
+    parser.add_argument('--broker', default=None,
+                        help="mosquitto broker 'host:port' (default: embedded broker stub)")
+    args = parser.parse_args()
+
+    print(Bench(args.token, args.sessions, args.seconds, args.batch, args.broker).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# Micro-benchmarks of the Python hot paths, on captures of 1k to 100k
+# samples: measure payload decoding and calibration, streaming with
+# rollover, the capture buffer, calibre_x_list, the row to column
+# conversion and JSON encoding of the API responses, the samples codec used
+# by plot_measure.py and the bokeh tokens.
+#
+# Timings depend on the machine, so no baseline is versioned: each machine
+# records its own in instance/microbench.json, e.g. before a change, and
+# the run fails if a case got slower than it by more than the tolerance:
+#   $ python manage.py microbench --save   # record the baseline
+#   $ python manage.py microbench          # compare with it
+# Without a baseline, the timings are only printed.
+#
+# The Flask cases (API responses, tokens) need APP_CONFIG, as manage.py.
+
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource
+
+import datetime
+import json
+import numpy
+import os
+import platform
+import sys
+import timeit
+import uuid
+
+MODELS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')
+ROOT_PATH   = os.path.abspath(os.path.join(MODELS_PATH, '..', '..', '..'))
+
+# same modules as the app scripts, see _bokeh.py
+sys.path.insert(0, MODELS_PATH)
+import util
+import decoder
+import samples
+from capture import CaptureBuffer
+
+SIZES     = (1000, 10000, 100000)
+FRAMES    = (1000, 10000, 65535)  # a binary frame has up to 65535 samples
+BASELINE  = os.path.join(ROOT_PATH, 'instance', 'microbench.json')
+TOLERANCE = 0.25  # slower than the baseline by more than 25% fails
+
+
+##############################################################################
+# Fixtures
+
+def capture(size, period=5):
+    """Force (N) and time (s) arrays of a capture sampled every 'period' ms."""
+
+    t = numpy.arange(size) * period * 1e-3
+    f = 20 + 15 * numpy.sin(t * numpy.pi / 2)
+    return f, t
+
+
+def text_payload(size, period=5):
+    """Measure payload as published by the device firmware."""
+
+    ticks = numpy.arange(size, dtype=numpy.int64) * period * 1000 + 1000
+    force = (2048 + 1500 * numpy.sin(ticks * (numpy.pi / 2e6))).astype(numpy.int64)
+    return "([%s])" % ",".join(map(str, numpy.column_stack((ticks, force)).ravel()))
+
+
+def binary_payload(size, period=5):
+    """Measure payload as a binary frame (see decoder.py)."""
+
+    records = numpy.zeros(size, dtype=decoder.BINARY_DTYPE)
+    records['t'] = numpy.arange(size) * period * 1000 + 1000
+    records['f'] = 2048
+    return decoder.BINARY_HEADER.pack(decoder.BINARY_MAGIC, size) + records.tobytes()
+
+
+def measurement_rows(size):
+    """get_measurement_from() like rows."""
+
+    from sqlalchemy.util import KeyedTuple
+
+    now    = datetime.datetime.utcnow()
+    labels = ['d_code', 'c_data', 'm_date', 'm_created', 'id']
+    return [KeyedTuple([
+        'device_%d' % (i % 5),
+        dict(angular=0.01, linear=0.),
+        now - datetime.timedelta(minutes=i),
+        now - datetime.timedelta(minutes=i),
+        uuid.uuid4(),
+    ], labels) for i in range(size)]
+
+
+##############################################################################
+# Cases: name -> function of a size returning the function to time, or of
+# no argument for the cases that do not depend on a size.
+
+def decode_text(size):
+    payload = text_payload(size)
+    return lambda: decoder.MeasureDecoder().decode(payload, 0.01, 0.5)
+
+
+def decode_binary(size):
+    payload = binary_payload(size)
+    return lambda: decoder.MeasureDecoder().decode(payload, 0.01, 0.5)
+
+
+def stream_rollover(size, rollover=6000):
+    # a full source in a document, as in palmar_grip.py
+    f, t   = capture(rollover)
+    source = ColumnDataSource(data=util.typed_columns(dict(f=f, t=t)))
+    Document().add_root(source)
+
+    f, t = capture(size)
+    new_data = dict(f=f, t=t + t[-1])
+    return lambda: util.stream_update(source, new_data, rollover)
+
+
+def capture_append(size, batch=50):
+    # decoded measures of 'batch' samples, as pushed by the mqtt hub
+    f, t   = capture(size)
+    chunks = [dict(f=f[i:i + batch], t=t[i:i + batch]) for i in range(0, size, batch)]
+
+    def run():
+        buffer = CaptureBuffer()
+        for chunk in chunks:
+            buffer.append(chunk)
+    return run
+
+
+def capture_window(size):
+    # a save of the middle tenth of the capture
+    f, t   = capture(size)
+    buffer = CaptureBuffer()
+    buffer.append(dict(f=f, t=t))
+    return lambda: buffer.window(t[size * 9 // 20], t[size * 11 // 20])
+
+
+def calibre_x_list(size):
+    values = list(numpy.random.RandomState(0).uniform(1, 4096, size))
+    return lambda: util.calibre_x_list(values)
+
+
+def columns_from(size):
+    from app._bokeh import views
+
+    rows = measurement_rows(size)
+    return lambda: views.columns_from(rows)
+
+
+def jsonify_columns(size):
+    from app import app
+    from app._bokeh import views
+    from flask import jsonify
+
+    columns = views.columns_from(measurement_rows(size))
+
+    def run():
+        with app.test_request_context():
+            return jsonify(columns)
+    return run
+
+
+def samples_loads(size):
+    text = samples.dumps(*capture(size))
+    return lambda: samples.loads(text)
+
+
+def generate_token():
+    from app.utils import token
+
+    return lambda: token.generate_token(dict(id=str(uuid.uuid4()), bokeh=None), 48)
+
+
+def confirm_token():
+    from app.utils import token
+
+    _token = token.generate_token(dict(id=str(uuid.uuid4()), bokeh=None), 48)
+    return lambda: token.confirm_token(_token)
+
+
+def confirm_token_uncached():
+    from app.utils import token
+
+    _token = token.generate_token(dict(id=str(uuid.uuid4()), bokeh=None), 48)
+
+    def run():
+        token.forget_token(_token)
+        return token.confirm_token(_token)
+    return run
+
+
+CASES = [
+    ('decode_text',            decode_text,            SIZES),
+    ('decode_binary',          decode_binary,          FRAMES),
+    ('stream_rollover',        stream_rollover,        SIZES),
+    ('capture_append',         capture_append,         SIZES),
+    ('capture_window',         capture_window,         SIZES),
+    ('calibre_x_list',         calibre_x_list,         SIZES),
+    ('columns_from',           columns_from,           SIZES),
+    ('jsonify_columns',        jsonify_columns,        SIZES),
+    ('samples_loads',          samples_loads,          SIZES),
+    ('generate_token',         generate_token,         None),
+    ('confirm_token',          confirm_token,          None),
+    ('confirm_token_uncached', confirm_token_uncached, None),
+]
+
+
+##############################################################################
+# Runner
+
+def time_it(func, min_time=0.2, repeat=5):
+    """Best time (s) of a call to 'func', over 'repeat' runs of enough calls
+    to last at least 'min_time' seconds.
+    """
+
+    timer  = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time and number < 1e6:
+        number *= 10
+
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(only=None, quick=False):
+    """Time the cases.
+
+    Args:
+        + only  : case names to run, or None for all.
+        + quick : run the cases only with their smallest size.
+
+    Return:
+        an ordered list of (case and size name, seconds per call).
+    """
+
+    results = []
+    for name, setup, sizes in CASES:
+        if only and name not in only:
+            continue
+
+        if sizes is None:
+            results.append((name, time_it(setup())))
+            continue
+
+        for size in sizes[:1] if quick else sizes:
+            results.append(("%s[%d]" % (name, size), time_it(setup(size))))
+
+    return results
+
+
+def load_baseline(path=BASELINE):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(results, path=BASELINE):
+    """Save results to the baseline, keeping the other cases' ones."""
+
+    baseline = load_baseline(path) or dict(results=dict())
+    baseline['results'].update(results)
+    baseline.update(
+        python  = platform.python_version(),
+        machine = platform.node(),
+        saved   = datetime.datetime.utcnow().isoformat(),
+    )
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Report the results against a baseline.
+
+    Return:
+        a (report lines, names of the regressed cases) tuple.
+    """
+
+    reference = (baseline or {}).get('results', {})
+    lines     = ["%-36s %12s %12s %8s" % ("case", "time", "baseline", "ratio")]
+    regressed = []
+
+    for name, seconds in results:
+        if name not in reference:
+            lines.append("%-36s %12s %12s %8s" % (name, _human(seconds), "-", "-"))
+            continue
+
+        ratio = seconds / reference[name]
+        if ratio > 1 + tolerance:
+            regressed.append(name)
+
+        lines.append("%-36s %12s %12s %7.2fx%s" % (name, _human(seconds),
+                     _human(reference[name]), ratio, "  SLOWER" if ratio > 1 + tolerance else ""))
+
+    return lines, regressed
+
+
+def _human(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.0f ns" % (seconds * 1e9)
@@ -0,0 +1,398 @@
+# Clients of the Flask API (app/_bokeh/views.py) used by the Bokeh apps.
+#
+# + ApiClient      : blocking client on a pooled keep-alive requests.Session,
+#                    for the session start up.
+# + AsyncApiClient : Tornado AsyncHTTPClient based client, for the calls made
+#                    from the document callbacks (e.g. saves), so the server's
+#                    IOLoop keeps serving the other sessions while waiting.
+#
+# With g.API_MODE = 'local' (Bokeh server running alongside the database),
+# LocalApiClient and AsyncLocalApiClient are used instead: they call the data
+# helpers of app/_bokeh/views.py in-process, with no HTTP round trip.
+#
+# Clients are shared by all the sessions of a Bokeh server process, see
+# get_client() and get_async_client(). Base URL, timeouts, retries and pool
+# size are set in g.py.
+
+import g
+import os
+import sys
+import json
+import metrics
+import uuid
+import time
+import datetime
+import threading
+import requests
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from tornado import gen
+from tornado.httputil import url_concat
+from tornado.httpclient import AsyncHTTPClient
+
+
+# HTTP codes retried on GET requests (and Tornado's 599, connection error
+# or timeout, by AsyncApiClient)
+RETRY_CODES = (502, 503, 504)
+
+
+class ApiError(Exception):
+    """Invalid or expired token, missing data or unreachable API."""
+    pass
+
+
+class BaseApiClient(object):
+    """URLs and response handling common to both clients.
+
+    Args:
+        + base_url        : Flask API URL, ending with a slash.
+        + connect_timeout : connection timeout (s).
+        + read_timeout    : response timeout (s).
+        + retries         : retries of failed GET requests.
+    """
+
+    def __init__(self, base_url=None, connect_timeout=g.API_CONNECT_TIMEOUT,
+                 read_timeout=g.API_READ_TIMEOUT, retries=g.API_RETRIES):
+        self.base_url        = base_url or g.BOKEH_HOST
+        self.connect_timeout = connect_timeout
+        self.read_timeout    = read_timeout
+        self.retries         = retries
+
+    def url(self, endpoint, token, *args):
+        """API URL, e.g. url('get_measure', token, m_id) returns
+        '<base_url>get_measure/<token>/<m_id>/'.
+        """
+
+        return "{}{}/".format(self.base_url, "/".join((endpoint, token) + args))
+
+    @staticmethod
+    def parse_json(code, body):
+        if code != 200 or body == "not_ok":
+            raise ApiError("API request failed (%s): %s" % (code, (body or "")[:20]))
+
+        return json.loads(body)
+
+    @staticmethod
+    def is_saved(code, body):
+        if g.BOKEH_DEV:
+            print "API response (%s): %s" % (code, (body or "")[:20]), "\n"
+
+        return code == 200 and body == "successfully_saved"
+
+
+class ApiClient(BaseApiClient):
+    """Blocking API client. Its connections are kept alive and pooled.
+
+    Args:
+        + pool_size : connections kept alive.
+        + **kwargs  : BaseApiClient arguments.
+    """
+
+    def __init__(self, pool_size=g.API_POOL_SIZE, **kwargs):
+        super(ApiClient, self).__init__(**kwargs)
+
+        # POST requests are not retried, a save could be made twice
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=self.retries,
+                backoff_factor=0.2,
+                status_forcelist=RETRY_CODES,
+                raise_on_status=False,
+            )
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, endpoint, token, *args, **params):
+        try:
+            with metrics.API_REQUESTS.time(endpoint=endpoint):
+                req = self.session.get(self.url(endpoint, token, *args), params=params,
+                                       timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException as e:
+            raise ApiError(str(e))
+
+        return self.parse_json(req.status_code, req.content)
+
+    def post(self, endpoint, token, data):
+        try:
+            with metrics.API_REQUESTS.time(endpoint=endpoint):
+                req = self.session.post(self.url(endpoint, token), json=data,
+                                        timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException as e:
+            raise ApiError(str(e))
+
+        return req.status_code, req.content
+
+    def get_devices(self, token):
+        return self.get('get_devices', token)
+
+    def get_calibrations(self, token):
+        return self.get('get_calibrations', token)
+
+    def get_measurement(self, token, **filters):
+        return self.get('get_measurement', token, **filters)
+
+    def get_measure(self, token, measure_id):
+        return self.get('get_measure', token, measure_id)
+
+    def save_calibration(self, token, data):
+        return self.is_saved(*self.post('save_calibration', token, data))
+
+    def save_measurement(self, token, data):
+        return self.is_saved(*self.post('save_measurement', token, data))
+
+
+class AsyncApiClient(BaseApiClient):
+    """Non-blocking API client: its methods return Tornado futures and must
+    be called from the server's IOLoop thread (e.g. document callbacks).
+
+    Args:
+        + max_clients : simultaneous requests, the others are queued.
+        + **kwargs    : BaseApiClient arguments.
+    """
+
+    def __init__(self, max_clients=g.API_POOL_SIZE, **kwargs):
+        super(AsyncApiClient, self).__init__(**kwargs)
+
+        self.http = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+    def fetch(self, url, **kwargs):
+        return self.http.fetch(
+            url,
+            raise_error=False,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.read_timeout,
+            **kwargs
+        )
+
+    @gen.coroutine
+    def get(self, endpoint, token, *args, **params):
+        url   = url_concat(self.url(endpoint, token, *args), params)
+        start = time.time()
+
+        for attempt in range(self.retries + 1):
+            response = yield self.fetch(url)
+            if response.code not in RETRY_CODES + (599,):
+                break
+            yield gen.sleep(0.2 * 2 ** attempt)
+
+        metrics.API_REQUESTS.observe(time.time() - start, endpoint=endpoint)
+        raise gen.Return(self.parse_json(response.code, response.body))
+
+    @gen.coroutine
+    def post(self, endpoint, token, data):
+        start    = time.time()
+        response = yield self.fetch(
+            self.url(endpoint, token),
+            method='POST',
+            body=json.dumps(data),
+            headers={'Content-Type': 'application/json'}
+        )
+
+        metrics.API_REQUESTS.observe(time.time() - start, endpoint=endpoint)
+        raise gen.Return((response.code, response.body))
+
+    def get_devices(self, token):
+        return self.get('get_devices', token)
+
+    def get_calibrations(self, token):
+        return self.get('get_calibrations', token)
+
+    def get_measurement(self, token, **filters):
+        return self.get('get_measurement', token, **filters)
+
+    def get_measure(self, token, measure_id):
+        return self.get('get_measure', token, measure_id)
+
+    @gen.coroutine
+    def save_calibration(self, token, data):
+        code, body = yield self.post('save_calibration', token, data)
+        raise gen.Return(self.is_saved(code, body))
+
+    @gen.coroutine
+    def save_measurement(self, token, data):
+        code, body = yield self.post('save_measurement', token, data)
+        raise gen.Return(self.is_saved(code, body))
+
+
+class LocalApiClient(object):
+    """In-process API client: same methods and results as ApiClient, made
+    by the app/_bokeh/views.py data helpers on the Flask app's database
+    session. The user id of a token is kept for g.API_TOKEN_TTL seconds,
+    which skips decoding it, and the token is checked against the user's row
+    on each call, so a rotated or revoked token is refused at once.
+    """
+
+    ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+    def __init__(self):
+        if self.ROOT_PATH not in sys.path:
+            sys.path.append(self.ROOT_PATH)
+
+        # requires APP_CONFIG, as the Flask app does
+        from app import app
+        from app.models import db, User, Measure
+        from app._bokeh import views
+        from app.utils.token import confirm_token
+
+        self.app         = app
+        self.db          = db
+        self.User        = User
+        self.Measure     = Measure
+        self.views       = views
+        self.confirm     = confirm_token
+        self.encoder     = app.json_encoder()
+
+        self._lock   = threading.Lock()
+        self._tokens = collections.OrderedDict()  # token -> (user id, time)
+
+    def user_from(self, token):
+        """User of a valid 'bokeh' token. Must be called within the app
+        context.
+        """
+
+        with self._lock:
+            user_id, checked_on = self._tokens.get(token, (None, 0))
+
+        cached = time.time() - checked_on < g.API_TOKEN_TTL
+        if not cached:
+            token_dict = self.confirm(token)
+            user_id    = isinstance(token_dict, dict) and token_dict.get('id')
+
+        # the row, not a cached snapshot: the token may have been rotated
+        # by another process
+        try:
+            user = user_id and self.User.query.get(uuid.UUID(str(user_id)))
+        except ValueError:
+            user = None
+
+        if not (user and user.has_valid_token(token, token_type='bokeh')):
+            raise ApiError("invalid or expired token.")
+
+        if not cached:
+            with self._lock:
+                self._tokens.pop(token, None)
+                self._tokens[token] = (user.id, time.time())
+                while len(self._tokens) > g.API_TOKEN_CACHE_SIZE:
+                    self._tokens.popitem(last=False)
+
+        return user
+
+    def plain(self, response):
+        """Convert UUIDs and dates of a response the way the Flask JSON
+        encoder does, so results match ApiClient ones.
+        """
+
+        if response is None:
+            raise ApiError("not found.")
+
+        for key, column in response.items():
+            if isinstance(column, list):
+                response[key] = [
+                    str(_v) if isinstance(_v, uuid.UUID) else
+                    self.encoder.default(_v) if isinstance(_v, datetime.date) else _v
+                    for _v in column
+                ]
+
+        return response
+
+    def call(self, token, func, *args, **kwargs):
+        # the app context teardown removes the database session
+        with self.app.app_context():
+            return func(self.user_from(token), *args, **kwargs)
+
+    def columns(self, token, rows_from):
+        def _columns(user):
+            rows = rows_from(user)
+            return self.views.columns_from(rows) if rows else None
+
+        return self.plain(self.call(token, _columns))
+
+    def get_devices(self, token):
+        return self.columns(token, self.views.get_devices_from)
+
+    def get_calibrations(self, token):
+        return self.columns(token, self.views.get_calibrations_from)
+
+    def get_measurement(self, token, **filters):
+        try:
+            filters = self.views.measurement_filters_from(filters)
+        except ValueError as e:
+            raise ApiError(str(e))
+
+        return self.plain(self.call(token, self.views.measurement_page_from, **filters))
+
+    def get_measure(self, token, measure_id):
+        return self.plain(self.call(token, self.views.measure_samples_from, measure_id))
+
+    def save(self, token, add, mapping_from, data):
+        def _save(user):
+            try:
+                add(mapping_from(data, user))
+                self.db.session.commit()
+            except ValueError:
+                return False
+            return True
+
+        try:
+            return self.call(token, _save)
+        except ApiError:
+            return False
+
+    def save_calibration(self, token, data):
+        with metrics.API_REQUESTS.time(endpoint='save_calibration'):
+            return self.save(token, self.views.add_calibration,
+                             self.views.calibration_mapping_from, data)
+
+    def save_measurement(self, token, data):
+        with metrics.API_REQUESTS.time(endpoint='save_measurement'):
+            return self.save(token, lambda mapping: self.db.session.add(self.Measure(**mapping)),
+                             self.views.measure_mapping_from, data)
+
+
+class AsyncLocalApiClient(object):
+    """Non-blocking LocalApiClient: its methods run on a thread pool and
+    return futures, as AsyncApiClient ones.
+
+    Args:
+        + client      : LocalApiClient.
+        + max_workers : threads, each one using its own database session.
+    """
+
+    def __init__(self, client=None, max_workers=g.API_POOL_SIZE):
+        self.client   = client or get_client()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        return lambda *args, **kwargs: self.executor.submit(method, *args, **kwargs)
+
+
+_clients      = dict()
+_clients_lock = threading.RLock()
+
+
+def _shared(cls):
+    with _clients_lock:
+        if cls not in _clients:
+            _clients[cls] = cls()
+        return _clients[cls]
+
+
+def get_client():
+    """Blocking API client shared by the sessions of this process."""
+
+    return _shared(LocalApiClient if g.API_MODE == 'local' else ApiClient)
+
+
+def get_async_client():
+    """Non-blocking API client shared by the sessions of this process."""
+
+    return _shared(AsyncLocalApiClient if g.API_MODE == 'local' else AsyncApiClient)
@@ -15,15 +15,17 @@ from varModel.varModel import VarModel
 
 # Mosquitto
 import json
-import paho.mqtt.client as mqtt
+import mqtt_hub
 
 # Others
 import g
-import re
 import util
 import time
+import api
 import numpy
-import requests
+import metrics
+import lifecycle
+from state import SessionState
 from scipy.optimize import leastsq
 
 
@@ -33,32 +35,29 @@ from scipy.optimize import leastsq
 # open a session to keep the local document in sync with server
 doc = curdoc()
 
-new_data = dict()
-
 try:
     args      = doc.session_context.request.arguments
-    g.TOKEN   = args.get('token')[0]
-    g.CTRL_ID = re.sub("[\W]", "", g.TOKEN)[7:23]
-
-    url = "{}get_devices/{}/".format(g.BOKEH_HOST, g.TOKEN)
-    req = requests.get(url)
-
-    if g.BOKEH_DEV:
-        print "req.content:", req.content[:20], "\n"
+    state     = SessionState(args.get('token')[0])
 
-    DEVICES = req.json()
+    DEVICES = api.get_client().get_devices(state.token)
 except:
     exit()
 
-g.device_id = DEVICES['code'][0]
-g.d_idx     = DEVICES['code'].index(g.device_id)
+state.device_id = DEVICES['code'][0]
+state.d_idx     = DEVICES['code'].index(state.device_id)
 
 ##############################################################################
 # Sources
 
-source      = ColumnDataSource(data=dict(f=[], v=[], index=[]))
-source_fit  = ColumnDataSource(data=dict(x=[], y=[]))
-source_regr = ColumnDataSource(data=dict(x=[], y=[]))
+# forces are typed in the table, so they are kept as float64
+POINT_DTYPES = dict(f=numpy.float64, v=numpy.int32, index=numpy.int32)
+
+source      = ColumnDataSource(data=util.typed_columns(dict(f=[], v=[], index=[]), POINT_DTYPES))
+source_fit  = ColumnDataSource(data=util.typed_columns(dict(x=[], y=[])))
+source_regr = ColumnDataSource(data=util.typed_columns(dict(x=[], y=[])))
+
+# streams the points read from the device to source
+streamer = util.StreamScheduler(doc, source, rollover=200)
 
 
 ##############################################################################
@@ -68,44 +67,20 @@ conn_status = VarModel()
 conn_status.value = False
 
 
-def on_connect(client, userdata, flags, rc):
-    if g.BOKEH_DEV:
-        if g.BOKEH_DEV:
-            print("\nMqtt: Connected with result code %s." % str(rc))
-
-    if rc == 0:
-        util.add_subscription(client, 'calibration')
+def on_connection_change(connected):
+    if not connected:
+        util.conn_status_update(conn_status, False)
 
 
-def on_disconnect(client, userdata, rc):
-    if rc != 0:
-        client.loop_stop()
+def on_message(msg):
+    if msg.topic == state.t_device_ctrl_cb:
+        on_message_device_cb(msg)
 
-        if g.BOKEH_DEV:
-            print("\nMqtt: Unexpected disconnection.\n")
-
-    util.doc_next_tick(doc, util.conn_status_update, conn_status, False)
+    elif msg.topic == state.t_calibration:
+        on_message_calibration(msg)
 
 
-def on_subscribe(client, userdata, mid, granted_qos):
-    if g.BOKEH_DEV:
-        print("\nMqtt: Subscribed with mid %s.\n" % mid)
-
-
-def on_unsubscribe(client, userdata, mid):
-    if g.BOKEH_DEV:
-        print("\nMqtt: Unsubscribed with mid %s." % mid)
-
-
-def on_message(client, userdata, msg):
-    if msg.topic == g.t_device_ctrl_cb:
-        on_message_device_cb(client, msg)
-
-    elif msg.topic == g.t_calibration:
-        on_message_calibration(client, msg)
-
-
-def on_message_device_cb(client, msg):
+def on_message_device_cb(msg):
     device_cb_msg = str(msg.payload)
 
     if g.BOKEH_DEV:
@@ -118,34 +93,34 @@ def on_message_device_cb(client, msg):
 
     elif device_cb_msg == 'ok_to_unsubscribe':
         new_conn_status = False
-        client.unsubscribe([g.t_calibration, g.t_device_ctrl_cb])
-        util.doc_next_tick(doc, util.add_subscription, client, 'calibration')
+        util.remove_subscription(hub, state, 'calibration', on_message)
+        util.add_subscription(hub, state, 'calibration', on_message, doc)
 
     elif device_cb_msg in ['successfully_disconnected', 'no_control_allowed',
         'esp_init', 'esp_interrupted']:
         new_conn_status = False
 
     if new_conn_status is not None:
-        util.doc_next_tick(doc, util.conn_status_update, conn_status, new_conn_status)
+        util.conn_status_update(conn_status, new_conn_status)
 
 
-def on_message_calibration(client, msg):
+def on_message_calibration(msg):
     try:
         data = json.loads(msg.payload)
     except:
+        metrics.PARSE_FAILURES.inc(app='calibration')
         if g.BOKEH_DEV:
             print(msg.payload)
         return
 
     if 'voltage' in data:
-        global new_data
-
         _data_index = source.data['index']
-        _new_index = [_data_index[-1] + 1] if _data_index else [0]
+        _new_index = [_data_index[-1] + 1] if len(_data_index) else [0]
 
         try:
             _new_v = [int(data['voltage'])]
         except:
+            metrics.PARSE_FAILURES.inc(app='calibration')
             if g.BOKEH_DEV:
                 print(data)
             return
@@ -164,19 +139,13 @@ def on_message_calibration(client, msg):
                 )
             )
 
+        streamer.push(new_data)
 
-client = mqtt.Client(
-    client_id=g.CTRL_ID,
-    clean_session=True
-)
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_subscribe = on_subscribe
-client.on_unsubscribe = on_unsubscribe
-client.on_message = on_message
 
-client.connect_async(host=g.MQTT_HOST, port=g.MQTT_PORT, keepalive=60)
-client.loop_start()
+# messages are handled on this document's next tick
+hub = mqtt_hub.get_hub()
+hub.add_listener(on_connection_change, doc)
+util.add_subscription(hub, state, 'calibration', on_message, doc)
 
 
 ##############################################################################
@@ -288,7 +257,7 @@ data_table = DataTable(
 
 _div                 = Div(text=""" """, height=4)
 checkbox             = CheckboxGroup(labels=['','',''], active=[0])
-device_slc           = Select(title="Device ID:", value=g.device_id, options=DEVICES['code'])
+device_slc           = Select(title="Device ID:", value=state.device_id, options=DEVICES['code'])
 device_conn_btn      = Toggle(label="Connect to device", button_type="success", active=True)
 read_point_btn       = Button(label="Read point", button_type="primary")
 clear_points_btn     = Button(label="Clear selected points", button_type="warning")
@@ -300,14 +269,14 @@ export_btn           = Button(label="Export points", button_type="success")
 
 # Select: esp device selection by Id
 def device_slc_callback(attr, old, new):
-    g.device_id = new
-    g.d_idx     = DEVICES['code'].index(g.device_id)
+    state.device_id = new
+    state.d_idx     = DEVICES['code'].index(state.device_id)
 
     if conn_status.value:
-        util.doc_next_tick(doc, util.device_control, client, "unsub")
+        util.doc_next_tick(doc, util.device_control, hub, state, "unsub")
     else:
-        client.unsubscribe([g.t_calibration, g.t_device_ctrl_cb])
-        util.doc_next_tick(doc, util.add_subscription, client, 'calibration')
+        util.remove_subscription(hub, state, 'calibration', on_message)
+        util.add_subscription(hub, state, 'calibration', on_message, doc)
 
 # Toggle button: esp device's connection control
 def device_conn_btn_callback(new):
@@ -317,21 +286,21 @@ def device_conn_btn_callback(new):
     else:
         command = "conn"
 
-    util.device_control(client, command)
+    util.device_control(hub, state, command)
 
 def read_point_btn_callback():
     if conn_status.value:
-        util.device_control(client, "calibrate")
+        util.device_control(hub, state, "calibrate")
 
 def clear_calibration_data():
     """ Helper function for clear_points_btn_callback() and
     clear_everything_btn_callback() functions.
     """
-    if source_fit.data['x'] or source_regr.data['x']:
-        source_fit.data.update(x=[], y=[])
-        source_regr.data.update(x=[], y=[])
+    if len(source_fit.data['x']) or len(source_regr.data['x']):
+        source_fit.data.update(util.typed_columns(dict(x=[], y=[])))
+        source_regr.data.update(util.typed_columns(dict(x=[], y=[])))
 
-        g.coef = []
+        state.coef = []
 
         checkbox.active    = [0]
         circle.visible     = True
@@ -351,13 +320,10 @@ def clear_points_btn_callback():
             print("Nothing to clear: no data selected.\n")
         return False
 
-    ds_indices.sort(reverse=True)
-
-    for i in ds_indices:
-        source.data['f'].pop(i)
-        source.data['v'].pop(i)
+    _f = numpy.delete(source.data['f'], ds_indices)
+    _v = numpy.delete(source.data['v'], ds_indices)
 
-    source.data['index'] = range(0, len(source.data['f']))
+    source.data = util.typed_columns(dict(f=_f, v=_v, index=numpy.arange(_f.size)), POINT_DTYPES)
 
     clear_calibration_data()
 
@@ -385,16 +351,16 @@ def clear_points_btn_callback():
         print " "
 
 def clear_everything_btn_callback():
-    source.data.update(f=[], v=[], index=[])
+    source.data.update(util.typed_columns(dict(f=[], v=[], index=[]), POINT_DTYPES))
     clear_calibration_data()
 
 def calibrate_btn_callback():
-    if not source.data['f']:
+    if not len(source.data['f']):
         if g.BOKEH_DEV:
             print "Calibration Fail: no data to calibrate.", "\n"
         return
 
-    g.coef = []
+    state.coef = []
     if g.WITH_LINEAR_COEF:
         fit = lambda p, x: p[0] + p[1]*(x)
     else:
@@ -404,42 +370,21 @@ def calibrate_btn_callback():
     # initial guess
     p0 = [0.0, 0.8] if g.WITH_LINEAR_COEF else [0.8]
 
-    _x_ds = list(source.data['v'])
-    _y_ds = list(source.data['f'])
+    _x_ds = numpy.asarray(source.data['v'], dtype=numpy.float64)
+    _y_ds = numpy.asarray(source.data['f'], dtype=numpy.float64)
 
-    # calls scipy.optimize.leastsq() to find optimal parameters and converts
-    # lists into numpy.array on the fly. Some info about convergence is
-    # in success and the optimized parameters in coef.
-    g.coef, success = leastsq(
+    # calls scipy.optimize.leastsq() to find optimal parameters. Some info
+    # about convergence is in success and the optimized parameters in coef.
+    state.coef, success = leastsq(
         err, p0,
-        args=(numpy.array(_x_ds), numpy.array(_y_ds)),
+        args=(_x_ds, _y_ds),
         ftol=5e-9, xtol=5e-9
     )
 
-    # Calibration curve
-    _x_regr = util.calibre_x_list(_x_ds)
-    if g.WITH_LINEAR_COEF:
-        source_regr.data.update(
-            y = [g.coef[1]*_i + g.coef[0] for _i in _x_regr],
-            x = _x_regr,
-        )
-
-        # Calibrated points
-        source_fit.data.update(
-            y = [g.coef[1]*_i + g.coef[0] for _i in _x_ds],
-            x = _x_ds,
-        )
-    else:
-        source_regr.data.update(
-            y = [g.coef[0]*_i for _i in _x_regr],
-            x = _x_regr,
-        )
-
-        # Calibrated points
-        source_fit.data.update(
-            y = [g.coef[0]*_i for _i in _x_ds],
-            x = _x_ds,
-        )
+    # Calibration curve, and calibrated points
+    _x_regr = numpy.asarray(util.calibre_x_list(_x_ds), dtype=numpy.float64)
+    source_regr.data.update(util.typed_columns(dict(y=fit(state.coef, _x_regr), x=_x_regr)))
+    source_fit.data.update(util.typed_columns(dict(y=fit(state.coef, _x_ds), x=_x_ds)))
 
     checkbox.active    = [0, 1, 2]
     circle.visible     = True
@@ -447,53 +392,55 @@ def calibrate_btn_callback():
     circle_fit.visible = True
 
     if g.WITH_LINEAR_COEF:
-        sign = '+' if g.coef[0] >= 0.0 else '-'
+        sign = '+' if state.coef[0] >= 0.0 else '-'
         plot.select_one('linear_regression').update(
             text = " linear regression: f(x) = %.8f * x %s %.8f " %
-                                               (abs(g.coef[1]), sign, abs(g.coef[0])),
+                                               (abs(state.coef[1]), sign, abs(state.coef[0])),
             border_line_alpha = 1.0,
             background_fill_alpha = 1.0,
         )
     else:
         plot.select_one('linear_regression').update(
-            text = " linear regression: f(x) = %.8f * x " % abs(g.coef[0]),
+            text = " linear regression: f(x) = %.8f * x " % abs(state.coef[0]),
             border_line_alpha = 1.0,
             background_fill_alpha = 1.0,
         )
 
     if g.BOKEH_DEV:
         print " "
-        print "coef:", g.coef
+        print "coef:", state.coef
         print "y_regr:", source_regr.data['y']
         print "x_regr:", source_regr.data['x']
         print "y_fit:", source_fit.data['y']
         print "x_fit:", source_fit.data['x']
 
 def save_btn_callback():
-    if not g.coef:
+    if not state.coef:
         if g.BOKEH_DEV:
             print "Nothing to save: no calibration data.", "\n"
         return False
 
     data_save = dict(
-        d_id = DEVICES['id'][g.d_idx],
-        lin  = g.coef[0] if g.WITH_LINEAR_COEF else 0,
-        ang  = g.coef[1] if g.WITH_LINEAR_COEF else g.coef[0],
+        d_id = DEVICES['id'][state.d_idx],
+        lin  = state.coef[0] if g.WITH_LINEAR_COEF else 0,
+        ang  = state.coef[1] if g.WITH_LINEAR_COEF else state.coef[0],
     )
 
-    url = "http://localhost:5000/bokeh/save_calibration/%s/" % g.TOKEN
-    req = requests.post(url, json=data_save)
+    # the IOLoop keeps serving the other sessions while the POST is in flight
+    future = api.get_async_client().save_calibration(state.token, data_save)
+    util.on_future_done(doc, future, save_done)
+
+    if g.BOKEH_DEV:
+        print "data_save:", data_save, "\n"
+
 
-    if req.content == "successfully_saved":
+def save_done(future):
+    if future.exception() is None and future.result():
         _text = "Calibration successfully saved!"
     else:
         _text = "Saving error: refresh the browser and try again."
     plot.select_one('save_confirmation').update(text=_text)
 
-    if g.BOKEH_DEV:
-        print "data_save:", data_save, "\n"
-        print "req.content:", req.content[:20], "\n"
-
 
 def clear_message(attr, old, new):
     plot.select_one('save_confirmation').update(text="")
@@ -636,14 +583,27 @@ export_btn.callback = CustomJS(
 
 
 ##############################################################################
-# Periodic streaming update call
+# Session lifecycle
 
-def periodic_stream():
-    global new_data
+def session_idle():
+    """Disconnect the device of a session idle for g.SESSION_IDLE_TIMEOUT."""
+    if conn_status.value:
+        util.device_control(hub, state, "disc")
 
-    if new_data:
-        util.doc_next_tick(doc, util.stream_update, source=source, new_data=new_data, rollover=200)
-        new_data = dict()
+
+def session_destroyed():
+    """Release the device, the hub callbacks and the buffers of a closed
+    session, and return the bytes released.
+    """
+    session_idle()
+    hub.remove_listener(on_connection_change)
+    util.remove_subscription(hub, state, 'calibration', on_message)
+
+    return streamer.close() + util.data_nbytes(source.data)
+
+
+lifecycle.on_idle(doc, session_idle, 'calibration')
+lifecycle.on_session_destroyed(doc, session_destroyed, 'calibration')
 
 
 ##############################################################################
@@ -668,5 +628,3 @@ doc.add_root(layout(
     ],
     sizing_mode = 'fixed',
 ))
-
-doc.add_periodic_callback(periodic_stream, g.SERVER_PERIOD)
@@ -0,0 +1,176 @@
+# Server-side capture of the streamed measures.
+#
+# The browser only keeps the last 'rollover' points of a stream, and with the
+# level of detail mode (g.STREAM_LOD) only a decimated view of them. This
+# buffer keeps every sample at full resolution, so selections made on the
+# plot are saved from the original samples, including the ones that already
+# rolled out of the plot.
+#
+# Samples are copied into preallocated chunks of g.CAPTURE_CHUNK_SIZE
+# samples. Once the full chunks kept in memory exceed g.CAPTURE_MEMORY_BUDGET
+# bytes, the oldest ones are spilled to a temporary file, so a long session
+# has a bounded memory use. A time window is read from the chunks it
+# overlaps only.
+
+import g
+import numpy
+import bisect
+import tempfile
+import threading
+
+
+SAMPLE_DTYPE = numpy.dtype([('t', '<f8'), ('f', '<f8')])
+
+
+class CaptureBuffer(object):
+    """Thread-safe, append-only buffer of force/time samples with increasing
+    time values.
+
+    Args:
+        + chunk_size : samples of each preallocated chunk.
+        + budget     : bytes of full chunks kept in memory before spilling
+                       the oldest ones to a temporary file.
+    """
+
+    def __init__(self, chunk_size=g.CAPTURE_CHUNK_SIZE, budget=g.CAPTURE_MEMORY_BUDGET):
+        self.chunk_size = chunk_size
+        self.budget     = budget
+
+        self._lock = threading.Lock()
+        self._file = None
+        self.clear()
+
+    def clear(self):
+        """Drop all samples and the temporary file."""
+
+        with self._lock:
+            # full chunks: [array, or None once spilled, file offset]
+            self._chunks  = []
+            self._firsts  = []   # first time of each full chunk, for bisect
+            self._current = numpy.empty(self.chunk_size, dtype=SAMPLE_DTYPE)
+            self._used    = 0    # samples of the current chunk
+            self._size    = 0
+            self._memory  = 0    # bytes of the full chunks in memory
+            self._spilled = 0    # bytes of the full chunks in the file
+
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        """Bytes kept in memory, the current chunk included."""
+
+        with self._lock:
+            return self._memory + self._current.nbytes
+
+    @property
+    def spilled(self):
+        """Bytes spilled to the temporary file."""
+
+        return self._spilled
+
+    def append(self, new_data):
+        """Append samples. Safe to call from any thread.
+
+        Args:
+            + new_data : column dict with 'f' and 't' columns.
+        """
+
+        f = numpy.asarray(new_data['f'], dtype=numpy.float64)
+        t = numpy.asarray(new_data['t'], dtype=numpy.float64)
+
+        with self._lock:
+            start = 0
+            while start < t.size:
+                count = min(t.size - start, self.chunk_size - self._used)
+                end   = self._used + count
+
+                self._current['t'][self._used:end] = t[start:start + count]
+                self._current['f'][self._used:end] = f[start:start + count]
+                self._used = end
+                start     += count
+
+                if self._used == self.chunk_size:
+                    self._push_current()
+
+            self._size += t.size
+
+    def _push_current(self):
+        chunk = self._current
+        self._chunks.append([chunk, None])
+        self._firsts.append(chunk['t'][0])
+        self._memory += chunk.nbytes
+
+        self._current = numpy.empty(self.chunk_size, dtype=SAMPLE_DTYPE)
+        self._used    = 0
+
+        # spill the oldest chunks still in memory
+        index = len(self._chunks) - self._memory // chunk.nbytes
+        while self._memory > self.budget and index < len(self._chunks):
+            self._spill(self._chunks[index])
+            index += 1
+
+    def _spill(self, item):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='capture_')
+
+        chunk = item[0]
+        self._file.seek(self._spilled)
+        chunk.tofile(self._file)
+
+        item[0], item[1] = None, self._spilled
+        self._spilled   += chunk.nbytes
+        self._memory    -= chunk.nbytes
+
+    def _read(self, item):
+        if item[0] is not None:
+            return item[0]
+
+        self._file.seek(item[1])
+        return numpy.fromfile(self._file, dtype=SAMPLE_DTYPE, count=self.chunk_size)
+
+    def _records(self, t_start=None, t_end=None):
+        # full chunks overlapping the window, then the current chunk
+        lo = 0 if t_start is None else max(bisect.bisect_right(self._firsts, t_start) - 1, 0)
+        hi = len(self._chunks) if t_end is None else bisect.bisect_right(self._firsts, t_end)
+
+        records = [self._read(item) for item in self._chunks[lo:hi]]
+        records.append(self._current[:self._used])
+        return records
+
+    @staticmethod
+    def _columns(records):
+        records = numpy.concatenate(records) if len(records) > 1 else records[0]
+        return records['f'], records['t']
+
+    def arrays(self):
+        """Return a (force, time) tuple with all the samples, read back from
+        the temporary file if some were spilled.
+        """
+
+        with self._lock:
+            records = self._records()
+        return self._columns(records)
+
+    def window(self, t_start, t_end):
+        """Samples within a time window.
+
+        Args:
+            + t_start : first time (s) of the window, inclusive.
+            + t_end   : last time (s) of the window, inclusive.
+
+        Return:
+            a (force, time) tuple of arrays.
+        """
+
+        with self._lock:
+            records = self._records(t_start, t_end)
+
+        # only the selected part of each chunk is copied
+        return self._columns([chunk[numpy.searchsorted(chunk['t'], t_start, side='left'):
+                                    numpy.searchsorted(chunk['t'], t_end, side='right')]
+                              for chunk in records])
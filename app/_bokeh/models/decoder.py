@@ -0,0 +1,125 @@
+# Batched decoder for the measure payloads published by the device on the
+# 'measure/<device_id>' topic.
+#
+# Two payload formats are accepted:
+#   + text   : anything ending with "[<time>,<force>,<time>,<force>,...])",
+#              the format sent by the current device firmware.
+#   + binary : little-endian frame made of a header (2 bytes magic "DG",
+#              uint16 number of samples) followed by that many records of
+#              int64 time (us) and int32 raw force.
+
+import re
+import numpy
+import struct
+
+
+PAYLOAD_RE = re.compile(r"(\[[0-9.,\s]+\])\)$")
+
+BINARY_MAGIC  = b'DG'
+BINARY_HEADER = struct.Struct('<2sH')
+BINARY_DTYPE  = numpy.dtype([('t', '<i8'), ('f', '<i4')])
+
+
+def parse_payload(payload):
+    """Parse a measure payload into raw NumPy arrays in one pass.
+
+    Args:
+        + payload : MQTT message payload (text or binary frame).
+
+    Return:
+        a (time, force) tuple of raw arrays: int64 device ticks (us) and
+        float64 raw force.
+
+    Raise:
+        ValueError if the payload can not be parsed.
+    """
+
+    if payload[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return parse_binary_frame(payload)
+
+    match = PAYLOAD_RE.search(payload)
+    if not match:
+        raise ValueError("payload does not end with a measures list.")
+
+    text = match.group(1)[1:-1]
+
+    # keep device ticks exact: they may not fit into a float64 mantissa
+    dtype  = numpy.float64 if '.' in text else numpy.int64
+    values = numpy.fromstring(text, dtype=dtype, sep=',')
+
+    if values.size == 0 or values.size % 2 != 0 or \
+       values.size != text.count(',') + 1:
+        raise ValueError("measures list must have [<time>,<force>,...] pairs.")
+
+    return values[0::2].astype(numpy.int64), values[1::2].astype(numpy.float64)
+
+
+def parse_binary_frame(payload):
+    """Parse a little-endian binary frame (see module header).
+
+    Args:
+        + payload : binary frame starting with BINARY_MAGIC.
+
+    Return:
+        a (time, force) tuple as in parse_payload().
+    """
+
+    if len(payload) < BINARY_HEADER.size:
+        raise ValueError("binary frame is too short.")
+
+    magic, count = BINARY_HEADER.unpack_from(payload)
+    if count == 0 or \
+       len(payload) != BINARY_HEADER.size + count * BINARY_DTYPE.itemsize:
+        raise ValueError("binary frame size does not match its header.")
+
+    records = numpy.frombuffer(payload, dtype=BINARY_DTYPE, count=count,
+                               offset=BINARY_HEADER.size)
+
+    return records['t'].astype(numpy.int64), records['f'].astype(numpy.float64)
+
+
+class MeasureDecoder(object):
+    """Decode measure payloads into calibrated, time rebased column dicts
+    ready to be streamed to a ColumnDataSource with 'f' and 't' columns.
+
+    The decoder keeps the last raw and rebased times between payloads, so
+    each application session must use its own instance.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Restart the time rebasing: the next sample will be at t = 0."""
+
+        self.t_raw_old = 0
+        self.t_old     = 0
+
+    def decode(self, payload, c_ang, c_lin=None):
+        """Decode a payload.
+
+        Args:
+            + payload : MQTT message payload (see parse_payload()).
+            + c_ang   : calibration's angular coefficient.
+            + c_lin   : calibration's linear coefficient.
+
+        Return:
+            a dict with float64 arrays: 'f' force (N) and 't' time (s).
+        """
+
+        t_raw, f_raw = parse_payload(payload)
+
+        # t_new[i] = t_old + t_raw[i] - t_raw_old, chained along the samples
+        if self.t_raw_old == 0:
+            t_new = t_raw - t_raw[0]
+        else:
+            t_new = t_raw + (self.t_old - self.t_raw_old)
+
+        self.t_raw_old = int(t_raw[-1])
+        self.t_old     = int(t_new[-1])
+
+        f_new = f_raw * c_ang
+        if c_lin:
+            f_new += c_lin
+
+        return dict(f=f_new, t=t_new * 1e-6)
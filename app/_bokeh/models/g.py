@@ -2,38 +2,52 @@
 import os
 
 # Bokeh
-BOKEH_HOST    = "http://localhost:5000/bokeh/"
+BOKEH_HOST    = os.environ.get('BOKEH_API_URL', "http://localhost:5000/bokeh/")
 BOKEH_DEV     = True if os.environ.get('BOKEH_PY_LOG_LEVEL') == 'debug' else False
 DEBOUNCE_VAL  = 200  # ms (int)
-SERVER_PERIOD = 5    # ms (int)
 DATA_FREQ_VAL = 5    # ms (int)
 
+# Bokeh server processes (_bokeh.py), worker i listens on BOKEH_PORT + i
+BOKEH_PORT    = int(os.environ.get('BOKEH_PORT', '5006'))
+BOKEH_WORKERS = int(os.environ.get('BOKEH_WORKERS', '1'))
+
+# Streaming to the browser (util.StreamScheduler)
+STREAM_LATENCY  = 50   # ms (int): max time a sample waits to be streamed
+STREAM_MAX_SIZE = 400  # samples (int): pending samples that force a stream
+STREAM_LOD      = False # stream a min/max decimated view sized to the plot width
+
+# Server-side capture of the streamed samples (capture.py)
+CAPTURE_CHUNK_SIZE    = 65536             # samples (int) of each preallocated chunk (1 MiB)
+CAPTURE_MEMORY_BUDGET = 16 * 1024 * 1024  # bytes (int) kept in memory, the older chunks go to a temporary file
+
+WAVEFORM_CACHE_SIZE = 20  # measurements (int): waveforms kept by plot_measure sessions
+
+# Session lifecycle (lifecycle.py)
+SESSION_IDLE_TIMEOUT  = 600  # s: idle sessions disconnect their device and free their buffers
+SESSION_REAP_INTERVAL = 60   # s: period of the idle sessions check
+
 TOOLS1 = "xpan, xbox_select, resize, xwheel_zoom, xwheel_pan, reset, crosshair, save"
 TOOLS2 = "pan, box_zoom, resize, xwheel_zoom, ywheel_zoom, xwheel_pan, ywheel_pan, reset, crosshair, save"
 TOOLS3 = "pan, box_select, box_zoom, resize, wheel_zoom, reset, save, crosshair, save"
 
-# Device index for calibration and measurement
-d_idx = None
+# Flask API clients (api.py)
+API_MODE             = os.environ.get('BOKEH_API_MODE', 'http')  # 'http' or 'local' (in-process)
+API_CONNECT_TIMEOUT  = 3     # s
+API_READ_TIMEOUT     = 10    # s
+API_RETRIES          = 2     # retries of failed GET requests
+API_POOL_SIZE        = 10    # connections kept alive
+API_TOKEN_TTL        = 60    # s: 'local' mode keeps the user id of a token this long
+API_TOKEN_CACHE_SIZE = 1000  # tokens
 
 # Calibration
 WITH_LINEAR_COEF = False
-coef             = []
-c_ang            = None
-c_lin            = None
 
 # Mosquitto
 MQTT_HOST = "localhost"
 MQTT_PORT = 1883
 
-TOKEN     = None
-CTRL_ID   = None
-device_id = None
-
-t_period         = ""
-t_device_ctrl    = ""
-t_measure        = ""
-t_device_ctrl_cb = ""
-t_calibration    = ""
+# Per-session values (token, device, calibration and topics) are kept in
+# state.SessionState, as this module is shared by all sessions.
 
 # Micropython timers
 # https://github.com/micropython/micropython/blob/master/tests/extmod/ticks_diff.py
@@ -0,0 +1,182 @@
+# Session lifecycle of the Bokeh apps.
+#
+# When a browser tab is closed, Bokeh discards its session once it has been
+# unused for a while and calls on_session_destroyed() on the Application,
+# which the app scripts cannot hook in Bokeh 0.12.6. So each Application gets
+# a SessionLifecycleHandler (see application()), and the scripts register
+# their teardown functions with on_session_destroyed(doc, func): without them
+# the mqtt hub would keep the session's subscriptions and callbacks, and with
+# them the document, its buffers and its device connection.
+#
+# The handler also starts a reaper in each server process, which runs the
+# on_idle() functions of the sessions idle for more than
+# g.SESSION_IDLE_TIMEOUT seconds, e.g. to disconnect their device. A session
+# is idle while its browser makes no change to the document and its stream
+# schedulers receive no sample.
+#
+# Teardown and idle functions may return the bytes they released, reported
+# by metrics.SESSIONS_RECLAIMED_BYTES (and printed in BOKEH_DEV mode).
+
+import g
+import time
+import util
+import metrics
+import traceback
+
+from bokeh.application import Application
+from bokeh.application.handlers import Handler, ScriptHandler
+
+
+class SessionRecord(object):
+    """Lifecycle of a single Bokeh document session.
+
+    Args:
+        + doc  : Bokeh application's curdoc().
+        + name : app name, for the reports.
+    """
+
+    def __init__(self, doc, name):
+        self.doc  = doc
+        self.name = name
+
+        self.teardown = []
+        self.idle     = []
+
+        self.active_on = time.time()
+        self.samples   = 0
+        self.reaped    = False
+
+        doc.on_change(self.on_change)
+
+    def on_change(self, event):
+        # changes made by the browser have the server session as setter
+        if getattr(event, 'setter', None) is not None:
+            self.touch()
+
+    def touch(self):
+        self.active_on = time.time()
+        self.reaped    = False
+
+    def pushed(self):
+        """Samples pushed to the session's stream schedulers."""
+        return sum(scheduler.pushed for scheduler in list(util.StreamScheduler.live)
+                   if scheduler.doc is self.doc)
+
+    def idle_for(self, now):
+        """Seconds since the last activity of the session."""
+
+        samples = self.pushed()
+        if samples != self.samples:
+            self.samples = samples
+            self.touch()
+
+        return now - self.active_on
+
+    def __repr__(self):
+        return '<SessionRecord:{}>'.format(self.name)
+
+
+# session id -> SessionRecord, of the sessions of this process
+_sessions = dict()
+_reaping  = False
+
+
+def _record(doc, name=None):
+    context = doc.session_context
+    if context is None:
+        return None
+
+    if context.id not in _sessions:
+        _sessions[context.id] = SessionRecord(doc, name or context.id)
+    return _sessions[context.id]
+
+
+def on_session_destroyed(doc, func, name=None):
+    """Register a function called when the session of a document is
+    destroyed. Nothing is done for a document without server session.
+
+    Args:
+        + doc  : Bokeh application's curdoc().
+        + func : function without arguments, returning the bytes released or
+                 None. Runs on the server's loop, outside the document lock.
+        + name : app name, for the reports.
+    """
+
+    record = _record(doc, name)
+    if record is not None:
+        record.teardown.append(func)
+
+
+def on_idle(doc, func, name=None):
+    """Register a function called on the next tick of a document, once its
+    session has been idle for g.SESSION_IDLE_TIMEOUT seconds. It is called
+    again after each new period of activity and idleness.
+
+    Args:
+        + doc  : Bokeh application's curdoc().
+        + func : function without arguments, returning the bytes released or
+                 None.
+        + name : app name, for the reports.
+    """
+
+    record = _record(doc, name)
+    if record is not None:
+        record.idle.append(func)
+
+
+def _run(record, funcs, event):
+    released = 0
+    for func in funcs:
+        try:
+            released += func() or 0
+        except Exception:
+            if g.BOKEH_DEV:
+                traceback.print_exc()
+
+    metrics.SESSIONS_ENDED.inc(app=record.name, event=event)
+    metrics.SESSIONS_RECLAIMED_BYTES.inc(released, app=record.name, event=event)
+
+    if g.BOKEH_DEV:
+        print("\nSession %s (%s) %s: %.1f KiB released." % (
+              record.doc.session_context.id, record.name, event, released / 1024.))
+
+
+def reap(timeout=g.SESSION_IDLE_TIMEOUT):
+    """Run the idle functions of the sessions idle for more than 'timeout'
+    seconds. Must run on the server's loop.
+    """
+
+    now = time.time()
+    for record in list(_sessions.values()):
+        if not record.reaped and record.idle_for(now) > timeout:
+            record.reaped = True
+            util.doc_next_tick(record.doc, _run, record, record.idle, 'reaped')
+
+
+class SessionLifecycleHandler(Handler):
+    """Application handler running the functions registered by the app
+    scripts when their sessions are destroyed, and starting the reaper of
+    idle sessions with the server.
+    """
+
+    safe_to_fork = True
+
+    def on_server_loaded(self, server_context):
+        global _reaping
+
+        # a single reaper for all the applications of the process
+        if not _reaping:
+            server_context.add_periodic_callback(reap, g.SESSION_REAP_INTERVAL * 1000)
+            _reaping = True
+
+    def on_session_destroyed(self, session_context):
+        record = _sessions.pop(session_context.id, None)
+        if record is not None:
+            record.doc.remove_on_change(record.on_change)
+            _run(record, record.teardown, 'destroyed')
+
+
+def application(filename):
+    """Application of an app script, with its sessions' lifecycle."""
+
+    return Application(ScriptHandler(filename=filename), SessionLifecycleHandler())
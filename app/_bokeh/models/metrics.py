@@ -0,0 +1,246 @@
+# Process metrics in the Prometheus text format.
+#
+# Counters, gauges and histograms are updated by the hot paths (mosquitto
+# messages, measure decoding, streaming, API calls, Flask requests) and
+# rendered by the '/metrics' endpoints of the Bokeh server (_bokeh.py) and
+# of the Flask app (app/utils/metrics.py).
+#
+# Like samples.py, this module has no dependencies on Flask or on the Bokeh
+# apps: it is imported as `metrics` by the Bokeh app scripts and as
+# `app._bokeh.models.metrics` by the Flask app. When both copies are loaded
+# in one process ('local' API mode) they share the same registry.
+
+import sys
+import time
+import bisect
+import threading
+import contextlib
+
+
+# seconds, from a fast in-process call to a slow HTTP request
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(object):
+    """Metrics and collectors rendered together."""
+
+    def __init__(self):
+        self._lock       = threading.Lock()
+        self._metrics    = []
+        self._collectors = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a function returning metrics to render, e.g. built from
+        the live sessions when the endpoint is scraped.
+        """
+
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """All the metrics in the Prometheus text format (version 0.0.4)."""
+
+        with self._lock:
+            metrics    = list(self._metrics)
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            metrics.extend(collector())
+
+        return ''.join(metric.render() for metric in metrics)
+
+
+class Metric(object):
+    """Base metric, with one value per set of label values.
+
+    Args:
+        + name     : metric name.
+        + doc      : help text.
+        + labels   : label names.
+        + registry : registry to add the metric to, or None.
+    """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=(), registry=None):
+        self.name   = name
+        self.doc    = doc
+        self.labels = tuple(labels)
+
+        self._lock   = threading.Lock()
+        self._values = dict()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+
+        lines = ['# HELP %s %s\n' % (self.name, self.doc), '# TYPE %s %s\n' % (self.name, self.kind)]
+        for key, value in items:
+            lines.extend(self._lines(key, value))
+        return ''.join(lines)
+
+    def _lines(self, key, value):
+        return ['%s%s %s\n' % (self.name, _labels(self.labels, key), _number(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. durations in seconds).
+
+    Args:
+        + buckets : upper bounds of the buckets, in increasing order.
+        + others  : Metric arguments.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key   = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration (s) of a 'with' block."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _lines(self, key, value):
+        counts, total = value
+        lines, count  = [], 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+            count += bucket
+            lines.append('%s_bucket%s %d\n' % (self.name,
+                         _labels(self.labels, key, [('le', _number(bound))]), count))
+
+        labels = _labels(self.labels, key)
+        lines.append('%s_sum%s %s\n' % (self.name, labels, _number(total)))
+        lines.append('%s_count%s %d\n' % (self.name, labels, count))
+        return lines
+
+
+REGISTRY = Registry()
+
+
+##############################################################################
+# Bokeh server
+
+MQTT_MESSAGES = Histogram(
+    'bokeh_mqtt_message_seconds',
+    "Mosquitto messages received and their dispatch time, by topic.",
+    labels=('topic',), registry=REGISTRY)
+
+PARSE_FAILURES = Counter(
+    'bokeh_parse_failures_total',
+    "Mosquitto payloads that could not be decoded, by app.",
+    labels=('app',), registry=REGISTRY)
+
+STREAM_FLUSH_SAMPLES = Histogram(
+    'bokeh_stream_flush_samples',
+    "Samples streamed by each StreamScheduler flush, before decimation.",
+    registry=REGISTRY, buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 6000))
+
+STREAM_FLUSH_LAG = Histogram(
+    'bokeh_stream_flush_lag_seconds',
+    "Time the oldest sample of a StreamScheduler flush waited to be streamed.",
+    registry=REGISTRY)
+
+STREAM_CALLS = Histogram(
+    'bokeh_stream_call_seconds',
+    "ColumnDataSource.stream() calls, sent to the browsers as websocket patches.",
+    registry=REGISTRY)
+
+SESSIONS_ENDED = Counter(
+    'bokeh_sessions_ended_total',
+    "Sessions destroyed or reaped after being idle, by app.",
+    labels=('app', 'event'), registry=REGISTRY)
+
+SESSIONS_RECLAIMED_BYTES = Counter(
+    'bokeh_sessions_reclaimed_bytes_total',
+    "Memory released by the sessions destroyed or reaped, by app.",
+    labels=('app', 'event'), registry=REGISTRY)
+
+API_REQUESTS = Histogram(
+    'bokeh_api_request_seconds',
+    "Flask API calls of the Bokeh apps (e.g. saves), by endpoint.",
+    labels=('endpoint',), registry=REGISTRY)
+
+
+##############################################################################
+# Flask app
+
+HTTP_REQUESTS = Histogram(
+    'flask_http_request_seconds',
+    "Flask requests, by endpoint, method and status.",
+    labels=('endpoint', 'method', 'status'), registry=REGISTRY)
+
+DB_QUERIES = Histogram(
+    'flask_db_queries_per_request',
+    "Database queries made by each Flask request, by endpoint.",
+    labels=('endpoint',), registry=REGISTRY, buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+
+
+# one registry per process, see the module header
+_other = sys.modules.get('app._bokeh.models.metrics' if __name__ == 'metrics' else 'metrics')
+if _other is not None:
+    globals().update((name, value) for name, value in vars(_other).items() if name.isupper())
@@ -0,0 +1,220 @@
+# Process-wide mosquitto connection shared by all Bokeh sessions.
+#
+# A single paho client (one network thread, one broker connection) serves
+# every session of the Bokeh server process. Sessions register callbacks for
+# the topics they need, subscriptions are reference counted at the broker and
+# messages are routed to the sessions' documents on the Tornado loop.
+#
+# The hub is started by _bokeh.py; app scripts get it with get_hub().
+
+import g
+import os
+import time
+import util
+import metrics
+import threading
+import traceback
+import paho.mqtt.client as mqtt
+
+
+class MqttHub(object):
+    """Shared mosquitto client with per-topic subscription reference count.
+
+    Args:
+        + host      : mosquitto broker host.
+        + port      : mosquitto broker port.
+        + keepalive : keepalive interval (s).
+        + client_id : mosquitto client id, unique for each server process.
+    """
+
+    def __init__(self, host=g.MQTT_HOST, port=g.MQTT_PORT, keepalive=60, client_id=None):
+        self.host      = host
+        self.port      = port
+        self.keepalive = keepalive
+        self.connected = False
+
+        self._lock        = threading.RLock()
+        self._subscribers = dict()  # topic -> [(callback, doc), ...]
+        self._listeners   = list()  # [(callback, doc), ...]
+
+        self._client = mqtt.Client(
+            client_id=client_id or "bokeh_hub_%d" % os.getpid(),
+            clean_session=True
+        )
+        self._client.on_connect    = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message    = self._on_message
+
+    def start(self):
+        """Connect to the broker and start the network thread. paho keeps
+        reconnecting from that thread if the connection is lost.
+        """
+
+        self._client.connect_async(host=self.host, port=self.port, keepalive=self.keepalive)
+        self._client.loop_start()
+
+    def stop(self):
+        """Disconnect from the broker and stop the network thread."""
+
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def subscribe(self, topics, callback, doc=None):
+        """Register a callback to the messages of some topics. The broker
+        subscription is made by the first callback of each topic.
+
+        Args:
+            + topics   : list of topic names.
+            + callback : function called with the message as its argument.
+            + doc      : Bokeh document to run the callback on its next tick,
+                         or None to run it on the hub's network thread.
+        """
+
+        with self._lock:
+            new_topics = []
+            for topic in topics:
+                subscribers = self._subscribers.setdefault(topic, [])
+                if not subscribers:
+                    new_topics.append(topic)
+                subscribers.append((callback, doc))
+
+            if new_topics and self.connected:
+                self._client.subscribe([(topic, 1) for topic in new_topics])
+
+        if g.BOKEH_DEV and new_topics:
+            print("\nMqtt hub: subscribing to %s." % ", ".join(new_topics))
+
+    def unsubscribe(self, topics, callback):
+        """Remove a callback from some topics. The broker subscription is
+        removed together with the last callback of each topic.
+
+        Args:
+            + topics   : list of topic names.
+            + callback : function previously given to subscribe().
+        """
+
+        with self._lock:
+            old_topics = []
+            for topic in topics:
+                subscribers = self._subscribers.get(topic, [])
+                for item in subscribers:
+                    if item[0] == callback:
+                        subscribers.remove(item)
+                        break
+
+                if topic in self._subscribers and not subscribers:
+                    del self._subscribers[topic]
+                    old_topics.append(topic)
+
+            if old_topics and self.connected:
+                self._client.unsubscribe(old_topics)
+
+        if g.BOKEH_DEV and old_topics:
+            print("\nMqtt hub: unsubscribing from %s." % ", ".join(old_topics))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Publish a message through the shared connection."""
+
+        return self._client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+
+    def add_listener(self, callback, doc=None):
+        """Register a callback called with True/False when the connection to
+        the broker is established or lost.
+
+        Args:
+            + callback : function called with the connection status.
+            + doc      : Bokeh document to run the callback on its next tick,
+                         or None to run it on the hub's network thread.
+        """
+
+        with self._lock:
+            self._listeners.append((callback, doc))
+
+    def remove_listener(self, callback):
+        """Remove a callback given to add_listener()."""
+
+        with self._lock:
+            self._listeners = [item for item in self._listeners if item[0] != callback]
+
+    def _dispatch(self, callback, doc, *args):
+        try:
+            if doc is None:
+                callback(*args)
+            else:
+                util.doc_next_tick(doc, callback, *args)
+        except Exception:
+            if g.BOKEH_DEV:
+                traceback.print_exc()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if g.BOKEH_DEV:
+            print("\nMqtt hub: connected with result code %s." % str(rc))
+
+        if rc != 0:
+            return
+
+        with self._lock:
+            self.connected = True
+            topics    = list(self._subscribers)
+            listeners = list(self._listeners)
+
+            # (re)subscribe once for all the sessions
+            if topics:
+                client.subscribe([(topic, 1) for topic in topics])
+
+        for callback, doc in listeners:
+            self._dispatch(callback, doc, True)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if g.BOKEH_DEV and rc != 0:
+            print("\nMqtt hub: unexpected disconnection.\n")
+
+        with self._lock:
+            self.connected = False
+            listeners = list(self._listeners)
+
+        for callback, doc in listeners:
+            self._dispatch(callback, doc, False)
+
+    def _on_message(self, client, userdata, msg):
+        start = time.time()
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(msg.topic, ()))
+
+        for callback, doc in subscribers:
+            self._dispatch(callback, doc, msg)
+
+        metrics.MQTT_MESSAGES.observe(time.time() - start, topic=msg.topic)
+
+
+_hub      = None
+_hub_lock = threading.Lock()
+
+
+def start_hub(hub_class=MqttHub, **kwargs):
+    """Create and start the hub of this process.
+
+    Args:
+        + hub_class : MqttHub or a subclass (e.g. bench.LoopbackHub).
+        + **kwargs  : hub_class arguments.
+
+    Return:
+        the started hub.
+    """
+
+    global _hub
+
+    with _hub_lock:
+        if _hub is None:
+            _hub = hub_class(**kwargs)
+            _hub.start()
+        return _hub
+
+
+def get_hub():
+    """Hub of this process, started with the default arguments if the server
+    did not start it (e.g. when running the apps with 'bokeh serve').
+    """
+
+    return _hub or start_hub()
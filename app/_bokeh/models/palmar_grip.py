@@ -5,9 +5,7 @@
 # TODO:
 #   * corrigir erro no modo vline do HoverTool para linhas horizontais
 #   * callback JS pra desconectar do mosquitto
-#       - quando a janela/aba do navegador for fechada
 #       - quando o servidor for desligado
-#       - quando a conexão estiver ociosa por mais de 10min
 
 # Bokeh
 from bokeh.layouts import widgetbox, row, column
@@ -23,14 +21,20 @@ from customHover.customHover import CustomHover
 
 # Mosquitto
 import json
-import paho.mqtt.client as mqtt
+import mqtt_hub
 
 # Others
 import g
-import re
 import util
 import time
-import requests
+import numpy
+import samples
+import capture
+import api
+import decoder
+import metrics
+import lifecycle
+from state import SessionState
 
 
 ##############################################################################
@@ -46,80 +50,52 @@ if g.BOKEH_DEV:
 # open a session to keep the local document in sync with server
 doc = curdoc()
 
-t_raw_old = 0
-t_old     = 0
-new_data  = dict()
+measure_decoder = decoder.MeasureDecoder()
 
 try:
     args      = doc.session_context.request.arguments
-    g.TOKEN   = args.get('token')[0]
-    g.CTRL_ID = re.sub("[\W]", "", g.TOKEN)[7:23]
+    state     = SessionState(args.get('token')[0])
 
-    url = "{}get_calibrations/{}/".format(g.BOKEH_HOST, g.TOKEN)
-    req = requests.get(url)
-
-    if g.BOKEH_DEV:
-        print "req.content:", req.content[:20], "\n"
-
-    CALIBRATIONS = req.json()
+    CALIBRATIONS = api.get_client().get_calibrations(state.token)
 except:
     exit()
 
-g.device_id = CALIBRATIONS['d_code'][0]
-g.d_idx     = CALIBRATIONS['d_code'].index(g.device_id)
-g.c_ang     = float(CALIBRATIONS['c_data'][g.d_idx]['angular'])
-g.c_lin     = float(CALIBRATIONS['c_data'][g.d_idx]['linear'])
+state.device_id = CALIBRATIONS['d_code'][0]
+state.d_idx     = CALIBRATIONS['d_code'].index(state.device_id)
+state.c_ang     = float(CALIBRATIONS['c_data'][state.d_idx]['angular'])
+state.c_lin     = float(CALIBRATIONS['c_data'][state.d_idx]['linear'])
 
 ##############################################################################
 # Sources
 
-source1   = ColumnDataSource(data=dict(f=[], t=[]))
-source2   = ColumnDataSource(data=dict(f=[], t=[]))
+source1   = ColumnDataSource(data=util.typed_columns(dict(f=[], t=[])))
+source2   = ColumnDataSource(data=util.typed_columns(dict(f=[], t=[])))
 data_freq = ColumnDataSource(data=dict(value=[]))
 
 ##############################################################################
 # Mosquitto
 
-conn_status = VarModel()
+conn_status = VarModel(name="conn_status")
 conn_status.value = False
 
 
-def on_connect(client, userdata, flags, rc):
-    if g.BOKEH_DEV:
-        print("Connected with result code " + str(rc))
-    if rc == 0:
-        util.add_subscription(client, 'measure')
-
-
-def on_disconnect(client, userdata, rc):
-    if rc != 0:
-        client.loop_stop()
-
-        if g.BOKEH_DEV:
-            print("Unexpected disconnection.")
-
-    util.doc_next_tick(doc, util.conn_status_update, conn_status, False)
-
-
-def on_subscribe(client, userdata, mid, granted_qos):
-    if g.BOKEH_DEV:
-        print("Subscribed with mid %s\n" % mid)
+def on_connection_change(connected):
+    if not connected:
+        util.conn_status_update(conn_status, False)
 
 
-def on_unsubscribe(client, userdata, mid):
-    if g.BOKEH_DEV:
-        print("Unsubscribed with mid %s\n" % mid)
-
-
-def on_message(client, userdata, msg):
-    if msg.topic == g.t_device_ctrl_cb:
-        on_message_device_cb(client, msg)
+def on_message(msg):
+    """Runs on the mqtt hub's network thread: measures go straight to the
+    stream scheduler, device callbacks are handled on the document's tick.
+    """
+    if msg.topic == state.t_device_ctrl_cb:
+        util.doc_next_tick(doc, on_message_device_cb, msg)
 
-    elif msg.topic == g.t_measure:
-        on_message_measure(client, msg)
+    elif msg.topic == state.t_measure:
+        on_message_measure(msg)
 
 
-def on_message_device_cb(client, msg):
+def on_message_device_cb(msg):
     """Callback function that handles messages from 't_device_ctrl_cb' topic
     which is used as a callback topic to return the results of the control
     commands sent to the device.
@@ -146,97 +122,54 @@ def on_message_device_cb(client, msg):
 
     elif device_cb_msg == 'ok_to_unsubscribe':
         new_conn_status = False
-        client.unsubscribe([g.t_measure, g.t_device_ctrl_cb])
-        util.doc_next_tick(doc, util.add_subscription, client, 'measure')
+        util.remove_subscription(hub, state, 'measure', on_message)
+        util.add_subscription(hub, state, 'measure', on_message)
 
     elif device_cb_msg in ['successfully_disconnected', 'no_control_allowed',
     'esp_init', 'esp_interrupted']:
         new_conn_status = False
 
         if not stream_data_btn.active:
-            util.doc_next_tick(doc, disable_stream)
+            disable_stream()
 
     if new_conn_status is not None:
-        util.doc_next_tick(doc, util.conn_status_update, conn_status, new_conn_status)
+        util.conn_status_update(conn_status, new_conn_status)
 
 
-def on_message_measure(client, msg):
+def on_message_measure(msg):
     if stream_data_btn.active: return
 
     try:
-        data = re.search("(\[[0-9.,\s]+\])\)$", msg.payload).group(1)
-        data = json.loads(data)
-    except Exception as e:
+        chunk = measure_decoder.decode(msg.payload, state.c_ang, state.c_lin)
+    except ValueError as e:
+        metrics.PARSE_FAILURES.inc(app='palmar_grip')
         if g.BOKEH_DEV:
             print("Exception with MQTT payload {}".format(e))
             print("MQTT payload: {}".format(msg.payload))
         return
 
-    if data and isinstance(data, list) and len(data) % 2 == 0:
-        global t_raw_old, t_old, new_data
-
-        for _index, _value in enumerate(data):
-            # data = [<time>,<force>,<time>,<force>,...]
-            if _index % 2 == 1: continue
-
-            try:
-                _new_f = float(data[_index+1]) * g.c_ang
-                _new_f = _new_f if not g.c_lin else _new_f + g.c_lin
-
-                t_raw_new = data[_index]
-
-                if t_raw_old == 0:
-                    _new_t = 0
-                else:
-                    _new_t = t_old + t_raw_new - t_raw_old
-                    # _new_t = t_old + util.esp_time_diff(t_raw_new, t_raw_old)
-
-                t_raw_old = t_raw_new
-                t_old = _new_t
-
-                if not new_data: new_data = dict(f=[], t=[])
-                new_data['f'].append(_new_f)
-                new_data['t'].append(float(_new_t) * 1e-6)
-
-                if g.BOKEH_DEV:
-                    print('f: %7.3f | t: %7.3f | f_raw: %5d | t_raw: %11d' % (
-                            new_data['f'][-1],
-                            new_data['t'][-1],
-                            data[_index+1],
-                            data[_index],
-                        )
-                    )
-            except Exception as e:
-                if g.BOKEH_DEV:
-                    print("Exception in processing measures: {}".format(e))
-                    print("Data in Exception: {}".format(data))
-                return
+    streamer.push(chunk)
 
-        # ''' FOR TESTING/DEBUG
-        if g.BOKEH_DEV:
-            with open(FILE_PATH, 'a') as dump_file:
-                dump_file.write("{}\n".format(msg.payload))
-        # '''
+    if g.BOKEH_DEV:
+        print('f: %s | t: %s' % (chunk['f'], chunk['t']))
 
+    # ''' FOR TESTING/DEBUG
+    if g.BOKEH_DEV:
+        with open(FILE_PATH, 'a') as dump_file:
+            dump_file.write("{}\n".format(msg.payload))
+    # '''
 
-client = mqtt.Client(
-    client_id=g.CTRL_ID,
-    clean_session=True
-)
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_subscribe = on_subscribe
-client.on_unsubscribe = on_unsubscribe
-client.on_message = on_message
 
-client.connect_async(host=g.MQTT_HOST, port=g.MQTT_PORT, keepalive=60)
-client.loop_start()
+hub = mqtt_hub.get_hub()
+hub.add_listener(on_connection_change, doc)
+util.add_subscription(hub, state, 'measure', on_message)
 
 
 ##############################################################################
 # Plot
 
 FOLLOW_INTERVAL  = 4.0  # sec (float)
+ROLLOVER         = 6000 # points kept by plot1
 TOOLBAR_LOCATION = "above"
 TOOLBAR_STICKY   = True
 
@@ -267,6 +200,23 @@ color   = brewer['Paired'][4][1]
 line1   = plot1.line(x='t', y='f', source=source1, color=color)
 circle1 = plot1.circle(x='t', y='f', source=source1, color=color)
 
+def lod_bucket(period):
+    """Time span (s) of a plot1 pixel column when the plot shows the
+    ROLLOVER samples of a device sampling every 'period' ms.
+    """
+    return ROLLOVER * period * 1e-3 / plot1.plot_width
+
+# coalesces decoded measures and streams them to source1; in level of detail
+# mode source1 gets a min/max view with about two points per pixel column of
+# the rollover span, updated with the sampling period. The full resolution
+# samples stay in 'capture_buffer', which the saves read
+capture_buffer = capture.CaptureBuffer()
+if g.STREAM_LOD:
+    streamer = util.StreamScheduler(doc, source1, rollover=ROLLOVER, capture=capture_buffer,
+        decimator=util.MinMaxDecimator(lod_bucket(g.DATA_FREQ_VAL)))
+else:
+    streamer = util.StreamScheduler(doc, source1, rollover=ROLLOVER, capture=capture_buffer)
+
 plot1.add_tools(CustomHover(
     tooltips = [
         ("force", "$~y{0.000}"),
@@ -361,9 +311,9 @@ source1.callback = CustomJS(
 ##############################################################################
 # Widgets
 
-device_slc           = Select(title="Device ID:", value=g.device_id, options=CALIBRATIONS['d_code'])
-device_conn_btn      = Toggle(label="Connect to device", button_type="success", active=True)
-stream_data_btn      = Toggle(label="Start streaming", button_type="primary", active=True)
+device_slc           = Select(title="Device ID:", value=state.device_id, options=CALIBRATIONS['d_code'], name="device_slc")
+device_conn_btn      = Toggle(label="Connect to device", button_type="success", active=True, name="device_conn_btn")
+stream_data_btn      = Toggle(label="Start streaming", button_type="primary", active=True, name="stream_data_btn")
 reset_stream_btn     = Button(label="Reset stream", button_type="danger")
 save_selection_btn   = Button(label="Save selection", button_type="success")
 export_selection_btn = Button(label="Export selection", button_type="primary")
@@ -371,26 +321,26 @@ data_freq_sld        = Slider(title="Period (ms)", value=g.DATA_FREQ_VAL, start=
 
 
 def device_frequency(period):
-    client.publish(
-        topic=g.t_period,
-        payload=json.dumps(dict(ctrl_id=g.CTRL_ID, period=period)),
+    hub.publish(
+        topic=state.t_period,
+        payload=json.dumps(dict(ctrl_id=state.ctrl_id, period=period)),
         qos=0,
         retain=False
     )
 
 # Select: esp device selection by Id
 def device_slc_callback(attr, old, new):
-    g.device_id = new
-    g.d_idx     = CALIBRATIONS['d_code'].index(g.device_id)
-    g.c_ang     = float(CALIBRATIONS['c_data'][g.d_idx]['angular'])
-    g.c_lin     = float(CALIBRATIONS['c_data'][g.d_idx]['linear'])
+    state.device_id = new
+    state.d_idx     = CALIBRATIONS['d_code'].index(state.device_id)
+    state.c_ang     = float(CALIBRATIONS['c_data'][state.d_idx]['angular'])
+    state.c_lin     = float(CALIBRATIONS['c_data'][state.d_idx]['linear'])
 
     if conn_status.value:
         disable_stream()
-        util.doc_next_tick(doc, util.device_control, client, "unsub")
+        util.doc_next_tick(doc, util.device_control, hub, state, "unsub")
     else:
-        client.unsubscribe([g.t_measure, g.t_device_ctrl_cb])
-        util.doc_next_tick(doc, util.add_subscription, client, 'measure')
+        util.remove_subscription(hub, state, 'measure', on_message)
+        util.add_subscription(hub, state, 'measure', on_message)
 
 # Toggle button: esp device's connection control
 def device_conn_btn_callback(toggle_val):
@@ -400,60 +350,72 @@ def device_conn_btn_callback(toggle_val):
     else:
         command="conn"
 
-    util.device_control(client, command)
+    util.device_control(hub, state, command)
 
 # Toggle button: stream data control
 def stream_data_btn_callback(toggle_val):
     if conn_status.value:
-        util.device_control(client, "toggle")
+        util.device_control(hub, state, "toggle")
 
 # Push button: reset stream
 def reset_stream_btn_callback():
-    global t_raw_old, new_data
     time.sleep(1e-3 * g.DEBOUNCE_VAL)
-    t_raw_old = 0
-    new_data = dict()
-    source1.data = dict(f=[], t=[])
+    measure_decoder.reset()
+    streamer.clear()
+    source1.data = util.typed_columns(dict(f=[], t=[]))
 
 # Push button: save selected stream data
-def save_selection_btn_callback():
+def selection_window():
+    """Force and time samples of the time window selected in source1, at
+    full resolution, sliced from the capture buffer. Returns None if nothing
+    is selected.
+    """
     ds_ind = source1.selected['1d']['indices']
     if not ds_ind:
+        return None
+
+    ds_t = numpy.take(source1.data['t'], ds_ind)
+    return capture_buffer.window(ds_t.min(), ds_t.max())
+
+def save_selection_btn_callback():
+    selection = selection_window()
+    if selection is None or not selection[1].size:
         if g.BOKEH_DEV:
             print "No data selected!", "\n"
         return False
 
+    ds_f, ds_t = selection
+
     data_save = dict(
-        d_id = CALIBRATIONS['d_id'][g.d_idx],
-        c_id = CALIBRATIONS['c_id'][g.d_idx],
-        f    = [],
-        t    = [],
+        d_id = CALIBRATIONS['d_id'][state.d_idx],
+        c_id = CALIBRATIONS['c_id'][state.d_idx],
+        s    = samples.dumps(ds_f, ds_t - ds_t[0]),
     )
 
-    ds_t_0 = source1.data['t'][ds_ind[0]]
-    for i in ds_ind:
-        data_save['f'].append("%.6f" %  source1.data['f'][i])
-        data_save['t'].append("%.6f" % (source1.data['t'][i] - ds_t_0))
+    # the IOLoop keeps serving the other sessions while the POST is in flight
+    future = api.get_async_client().save_measurement(state.token, data_save)
+    util.on_future_done(doc, future, save_selection_done)
+
+    if g.BOKEH_DEV:
+        print "len(ds_t):", len(ds_t), "\n"
+        print "data_save:", data_save, "\n"
 
-    url = "http://localhost:5000/bokeh/save_measurement/%s/" % g.TOKEN
-    req = requests.post(url, json=data_save)
 
-    if req.content == "successfully_saved":
+def save_selection_done(future):
+    if future.exception() is None and future.result():
         _text = "Measurement successfully saved!"
     else:
         _text = "Saving error: refresh the browser and try again."
     plot2.select_one('save_confirmation').update(text=_text)
 
-    if g.BOKEH_DEV:
-        print "ds_ind:", ds_ind, "\n"
-        print "data_save:", data_save, "\n"
-        print "req.content:", req.content[:20], "\n"
-
 
 # Slider: frequency of measurement acquisition
 def data_freq_sld_callback(attr, old, new):
     new = data_freq.data['value'][0]
 
+    if streamer.decimator is not None:
+        streamer.decimator.bucket = lod_bucket(new)
+
     disable_stream()
     if conn_status.value: device_frequency(new)
 
@@ -466,6 +428,13 @@ def clear_message(attr, old, new):
     plot2.select_one('save_confirmation').update(text="")
 
 
+def upd_selection_source(attr, old, new):
+    selection = selection_window()
+    if selection is not None and selection[1].size:
+        ds_f, ds_t = selection
+        source2.data = util.typed_columns(dict(f=ds_f, t=ds_t - ds_t[0]))
+
+
 def disable_stream():
     stream_data_btn.update(
         active = True,
@@ -476,6 +445,10 @@ def disable_stream():
 
 source1.on_change('selected', clear_message)
 
+# replaces the decimated selection set by source1.callback in the browser
+if g.STREAM_LOD:
+    source1.on_change('selected', upd_selection_source)
+
 device_slc.on_change('value', device_slc_callback)
 device_slc.js_on_change('value', CustomJS(
     args = dict(btn=reset_stream_btn),
@@ -532,9 +505,17 @@ stream_data_btn.callback = CustomJS(
             cb_obj.label = "Start streaming";
             cb_obj.button_type = "primary";
 
+            // breaks the line: the columns are typed arrays, without push()
             setTimeout(function(){
-                s1.data['t'].push('nan');
-                s1.data['f'].push('nan');
+                ['t', 'f'].forEach(function(key) {
+                    var col = s1.data[key];
+                    var tmp = new col.constructor(col.length + 1);
+                    for (var i = 0; i < col.length; i++) {
+                        tmp[i] = col[i];
+                    }
+                    tmp[col.length] = NaN;
+                    s1.data[key] = tmp;
+                });
             },""" + str(g.DEBOUNCE_VAL) + """);
         }
 
@@ -550,8 +531,8 @@ reset_stream_btn.callback = CustomJS(
         p2 = plot2
     ),
     code = """
-        s1.data['t'] = [];
-        s1.data['f'] = [];
+        s1.data['t'] = new s1.data['t'].constructor(0);
+        s1.data['f'] = new s1.data['f'].constructor(0);
         s1.trigger('change');
 
         p1.toolbar.tools[""" + util.reset_tool_index(g.TOOLS1) + """].trigger('do');
@@ -627,14 +608,28 @@ data_freq_sld.callback = CustomJS(
 
 
 ##############################################################################
-# Periodic streaming update call
+# Session lifecycle
+
+def session_idle():
+    """Disconnect the device of a session idle for g.SESSION_IDLE_TIMEOUT."""
+    if conn_status.value:
+        util.device_control(hub, state, "disc")
+
+
+def session_destroyed():
+    """Release the device, the hub callbacks and the buffers of a closed
+    session, and return the bytes released.
+    """
+    session_idle()
+    hub.remove_listener(on_connection_change)
+    util.remove_subscription(hub, state, 'measure', on_message)
+    measure_decoder.reset()
+
+    return streamer.close() + util.data_nbytes(source1.data) + util.data_nbytes(source2.data)
 
-def periodic_stream():
-    global new_data
 
-    if new_data:
-        util.doc_next_tick(doc, util.stream_update, source=source1, new_data=new_data)
-        new_data = dict()
+lifecycle.on_idle(doc, session_idle, 'palmar_grip')
+lifecycle.on_session_destroyed(doc, session_destroyed, 'palmar_grip')
 
 
 ##############################################################################
@@ -653,4 +648,3 @@ doc.add_root(row(
     ),
     column(plot1, plot2)
 ))
-doc.add_periodic_callback(periodic_stream, g.SERVER_PERIOD)
@@ -7,8 +7,8 @@
 from bokeh.layouts import column
 from bokeh.plotting import figure, curdoc
 from bokeh.palettes import brewer
-from bokeh.models import ColumnDataSource, CustomJS, Grid
-from bokeh.models.widgets import DataTable, TableColumn, NumberFormatter
+from bokeh.models import ColumnDataSource, CustomJS, Grid, Label
+from bokeh.models.widgets import DataTable, TableColumn, NumberFormatter, Button
 
 # Custom models
 from timeAxis.timeAxis import TimeAxis
@@ -16,9 +16,13 @@ from customHover.customHover import CustomHover
 
 # Others
 import g
-import re
 import util
-import requests
+import api
+import samples
+import lifecycle
+import functools
+from state import SessionState
+from collections import OrderedDict
 
 
 ##############################################################################
@@ -29,36 +33,63 @@ doc = curdoc()
 
 try:
     args      = doc.session_context.request.arguments
-    g.TOKEN   = args.get('token')[0]
-    g.CTRL_ID = re.sub("[\W]", "", g.TOKEN)[7:23]
+    state     = SessionState(args.get('token')[0])
 
-    url = "{}get_measurement/{}/".format(g.BOKEH_HOST, g.TOKEN)
-    req = requests.get(url)
-
-    if g.BOKEH_DEV:
-        print "req:", req, "\n"
-
-    MEASURES = req.json()
-    MEASURES['m_data'] = [{k:[float(v) for v in _list] for k,_list in _dict.items()} for _dict in MEASURES['m_data']]
+    # only the measurements metadata, waveforms are loaded on selection
+    MEASURES = api.get_client().get_measurement(state.token)
 except:
     exit()
 
+# waveforms of the last selected measurements: id -> (force, time)
+WAVEFORMS = OrderedDict()
+
+
+def cache_waveform(m_id, measure):
+    """Cache the waveform of a measurement from its get_measure response
+    and return it as a (force, time) tuple of arrays.
+    """
+
+    _f, _t = samples.loads(measure['m_samples'])
+    # forces are float32 in the samples: cached with the source dtypes
+    WAVEFORMS[m_id] = _f.astype(util.SAMPLE_DTYPES['f']), _t
+
+    while len(WAVEFORMS) > g.WAVEFORM_CACHE_SIZE:
+        WAVEFORMS.popitem(last=False)
+
+    return WAVEFORMS[m_id]
+
+
+def cached_waveform(m_id):
+    """Waveform of a measurement from the cache, or None."""
+
+    if m_id in WAVEFORMS:
+        WAVEFORMS[m_id] = WAVEFORMS.pop(m_id)
+        return WAVEFORMS[m_id]
+    return None
+
+
+def table_columns_from(measures, first_index=0):
+    return dict(
+        m_datetime = measures['m_date'],
+        d_code     = measures['d_code'],
+        c_ang      = [_d['angular'] for _d in measures['c_data']],
+        c_lin      = [_d['linear'] for _d in measures['c_data']],
+        index      = range(first_index, first_index + len(measures['id']))
+    )
+
 
 ##############################################################################
 # Sources
 
-source = ColumnDataSource(data=dict(
-    f = MEASURES['m_data'][0]['force'],
-    t = MEASURES['m_data'][0]['time']
-))
+# the first waveform is loaded with the document
+_m_id  = MEASURES['id'][0]
+_f, _t = cache_waveform(_m_id, api.get_client().get_measure(state.token, _m_id))
+source = ColumnDataSource(data=util.typed_columns(dict(
+    f = _f,
+    t = _t
+)))
 
-source_table = ColumnDataSource(data=dict(
-    m_datetime = MEASURES['m_date'],
-    d_code     = MEASURES['d_code'],
-    c_ang      = [_d['angular'] for _d in MEASURES['c_data']],
-    c_lin      = [_d['linear'] for _d in MEASURES['c_data']],
-    index      = range(len(MEASURES['id']))
-))
+source_table = ColumnDataSource(data=table_columns_from(MEASURES))
 source_table.selected['1d']['indices'] = [0]
 
 
@@ -122,15 +153,65 @@ data_table = DataTable(
     ]
 )
 
+plot.add_layout(Label(
+    name                  = "status_message",
+    x                     = 80,
+    y                     = plot.plot_height - 50,
+    x_units               = 'screen',
+    y_units               = 'screen',
+    render_mode           = 'canvas',
+    text                  = "",
+    text_color            = 'red',
+    text_font_size        = '1em',
+    text_font_style       = 'bold',
+    text_align            = 'left',
+    text_baseline         = 'middle',
+    border_line_alpha     = 0.0,
+    background_fill_color = 'white',
+    background_fill_alpha = 1.0,
+))
+
+def set_status(text):
+    plot.select_one('status_message').update(text=text)
+
+
+def show_waveform(waveform):
+    _f, _t = waveform
+    source.data.update(util.typed_columns(dict(
+        f = _f,
+        t = _t
+    )))
+
+
 def upd_plot_source(attr, old, new):
     old_ind = old['1d']['indices']
     new_ind = new['1d']['indices']
 
     if new_ind and new_ind != old_ind:
-        source.data.update(
-            f = MEASURES['m_data'][new_ind[0]]['force'],
-            t = MEASURES['m_data'][new_ind[0]]['time']
-        )
+        m_id     = MEASURES['id'][new_ind[0]]
+        waveform = cached_waveform(m_id)
+        if waveform is not None:
+            set_status("")
+            show_waveform(waveform)
+            return
+
+        # the IOLoop keeps serving the other sessions while the GET is in flight
+        future = api.get_async_client().get_measure(state.token, m_id)
+        util.on_future_done(doc, future, functools.partial(upd_plot_source_done, m_id))
+
+
+def upd_plot_source_done(m_id, future):
+    if future.exception() is not None or not future.result():
+        set_status("Loading error: refresh the browser and try again.")
+        return
+
+    waveform = cache_waveform(m_id, future.result())
+
+    # only if the row is still selected
+    ind = source_table.selected['1d']['indices']
+    if ind and MEASURES['id'][ind[0]] == m_id:
+        set_status("")
+        show_waveform(waveform)
 
 source_table.on_change('selected', upd_plot_source)
 source_table.js_on_change('selected', CustomJS(
@@ -141,7 +222,58 @@ source_table.js_on_change('selected', CustomJS(
 ))
 
 
+load_more_btn = Button(label="Load older measurements", width=800,
+                       disabled=not MEASURES['next'])
+
+def load_more_btn_callback():
+    load_more_btn.disabled = True
+
+    future = api.get_async_client().get_measurement(state.token, before=MEASURES['next'])
+    util.on_future_done(doc, future, load_more_done)
+
+
+def load_more_done(future):
+    if future.exception() is not None or not future.result():
+        set_status("Loading error: refresh the browser and try again.")
+        load_more_btn.disabled = False
+        return
+
+    set_status("")
+    measures = future.result()
+
+    # no older measurement, e.g. deleted since the previous page
+    if not measures['id']:
+        MEASURES['next'] = None
+        load_more_btn.disabled = True
+        return
+
+    source_table.stream(table_columns_from(measures, len(MEASURES['id'])))
+    for key in ['id', 'm_date', 'd_code', 'c_data']:
+        MEASURES[key].extend(measures[key])
+    MEASURES['next'] = measures['next']
+
+    load_more_btn.disabled = not MEASURES['next']
+
+load_more_btn.on_click(load_more_btn_callback)
+
+
+##############################################################################
+# Session lifecycle
+
+def clear_waveforms():
+    """Drop the cached waveforms, reloaded on selection, and return the
+    bytes released.
+    """
+    released = sum(force.nbytes + time.nbytes for force, time in WAVEFORMS.values())
+    WAVEFORMS.clear()
+    return released
+
+
+lifecycle.on_idle(doc, clear_waveforms, 'plot_measure')
+lifecycle.on_session_destroyed(doc, clear_waveforms, 'plot_measure')
+
+
 ##############################################################################
 # Bokeh doc
 
-doc.add_root(column(plot, data_table))
+doc.add_root(column(plot, data_table, load_more_btn))
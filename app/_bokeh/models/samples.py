@@ -0,0 +1,100 @@
+# Compact binary codec for measure samples.
+#
+# This module has no dependencies on Flask or on the Bokeh apps so it can be
+# imported from both sides: as `samples` by the Bokeh app scripts and as
+# `app._bokeh.models.samples` by the Flask views.
+#
+# Format version 1 (little-endian):
+#   + header : uint8 format version, uint32 number of samples (n)
+#   + time   : n int32 microsecond deltas, the first one relative to zero
+#   + force  : n float32 values
+
+import numpy
+import base64
+import struct
+
+
+FORMAT_VERSION = 1
+
+HEADER      = struct.Struct('<BI')
+TIME_DTYPE  = numpy.dtype('<i4')
+FORCE_DTYPE = numpy.dtype('<f4')
+
+
+def pack(force, time):
+    """Pack force and time samples into a binary blob.
+
+    Args:
+        + force : sequence of force values (N).
+        + time  : sequence of time values (s), in increasing order.
+
+    Return:
+        a bytes object in the current FORMAT_VERSION.
+    """
+
+    force = numpy.asarray(force, dtype=numpy.float64)
+    time  = numpy.asarray(time, dtype=numpy.float64)
+
+    if force.ndim != 1 or force.shape != time.shape:
+        raise ValueError("force and time must be 1d sequences of equal length.")
+
+    t_us   = numpy.rint(time * 1e6).astype(numpy.int64)
+    deltas = numpy.concatenate((t_us[:1], numpy.diff(t_us)))
+
+    limits = numpy.iinfo(TIME_DTYPE)
+    if deltas.size and (deltas.min() < limits.min or deltas.max() > limits.max):
+        raise ValueError("time deltas do not fit into int32 microseconds.")
+
+    return b''.join([
+        HEADER.pack(FORMAT_VERSION, deltas.size),
+        deltas.astype(TIME_DTYPE).tobytes(),
+        force.astype(FORCE_DTYPE).tobytes(),
+    ])
+
+
+def unpack(blob):
+    """Unpack a binary blob created by pack().
+
+    Args:
+        + blob : bytes-like object (bytes, buffer, memoryview).
+
+    Return:
+        a (force, time) tuple of float64 NumPy arrays.
+    """
+
+    blob = bytes(blob)
+    if len(blob) < HEADER.size:
+        raise ValueError("samples blob is too short.")
+
+    version, count = HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION:
+        raise ValueError("unknown samples format version: %s" % version)
+
+    expected = HEADER.size + count * (TIME_DTYPE.itemsize + FORCE_DTYPE.itemsize)
+    if len(blob) != expected:
+        raise ValueError("samples blob has %d bytes, expected %d." % (len(blob), expected))
+
+    offset = HEADER.size
+    deltas = numpy.frombuffer(blob, dtype=TIME_DTYPE, count=count, offset=offset)
+    offset += count * TIME_DTYPE.itemsize
+    force  = numpy.frombuffer(blob, dtype=FORCE_DTYPE, count=count, offset=offset)
+
+    time = numpy.cumsum(deltas, dtype=numpy.int64) * 1e-6
+    return force.astype(numpy.float64), time
+
+
+def dumps(force, time):
+    """Pack samples into a base64 string to be sent inside JSON documents."""
+
+    return base64.b64encode(pack(force, time)).decode('ascii')
+
+
+def loads(text):
+    """Unpack samples from a base64 string created by dumps()."""
+
+    try:
+        blob = base64.b64decode(text)
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid base64 samples: %s" % e)
+
+    return unpack(blob)
@@ -0,0 +1,40 @@
+# Per-session state for the Bokeh apps.
+#
+# Modules such as 'g' and 'util' are imported once per Bokeh server process
+# and are shared by every session, so anything that belongs to a single
+# browser session (token, device, calibration, mosquitto topics) must live in
+# a SessionState instance created by the app script.
+
+import re
+
+
+class SessionState(object):
+    """State of a single Bokeh document session.
+
+    Args:
+        token (str):
+            Bokeh token received in the session request arguments.
+    """
+
+    def __init__(self, token):
+        self.token   = token
+        self.ctrl_id = re.sub("[\W]", "", token)[7:23]
+
+        # Device index for calibration and measurement
+        self.device_id = None
+        self.d_idx     = None
+
+        # Calibration
+        self.coef  = []
+        self.c_ang = None
+        self.c_lin = None
+
+        # Mosquitto topics
+        self.t_period         = ""
+        self.t_device_ctrl    = ""
+        self.t_measure        = ""
+        self.t_device_ctrl_cb = ""
+        self.t_calibration    = ""
+
+    def __repr__(self):
+        return '<SessionState:{}>'.format(self.ctrl_id)
@@ -1,12 +1,43 @@
 import g
 import json
 import math
+import time
+import numpy
+import metrics
+import weakref
 import functools
+import threading
+import collections
+
+
+# dtypes of the ColumnDataSource columns: NumPy arrays of these dtypes are
+# sent to the browsers as binary (base64) arrays instead of JSON lists.
+# Forces are saved as float32 anyway (see samples.py), times stay float64 so
+# long sessions keep their resolution.
+SAMPLE_DTYPES = dict(f=numpy.float32, t=numpy.float64)
+
+
+def doc_loop(doc):
+    """Tornado IOLoop running a document's server session, or None if the
+    document has no server session.
+
+    Args:
+        + doc : Bokeh application's curdoc().
+    """
+
+    try:
+        return doc.session_context.server_context.application_context.io_loop
+    except AttributeError:
+        return None
 
 
 def doc_next_tick(doc, func, *args, **kwargs):
     """Schedule a function execution using Bokeh Tornado threads for the
-    next Tornado loop.
+    next Tornado loop. Safe to call from any thread.
+
+    Bokeh registers a next tick callback after handing it to the IOLoop, so
+    when it is added from another thread the loop may run it first and drop
+    it as already removed: the callback is added from the loop instead.
 
     Args:
         + doc     : Bokeh application's curdoc().
@@ -15,7 +46,27 @@ def doc_next_tick(doc, func, *args, **kwargs):
         + **kargs : function's key arguments.
     """
 
-    doc.add_next_tick_callback(functools.partial(func, *args, **kwargs))
+    callback = functools.partial(func, *args, **kwargs)
+
+    loop = doc_loop(doc)
+    if loop is None:
+        doc.add_next_tick_callback(callback)
+    else:
+        loop.add_callback(doc.add_next_tick_callback, callback)
+
+
+def on_future_done(doc, future, func):
+    """Call a function with a Tornado future, once it is done, on the next
+    tick of a document, so the function can update the document's models.
+
+    Args:
+        + doc    : Bokeh application's curdoc().
+        + future : Tornado future, e.g. from api.AsyncApiClient.
+        + func   : function's name.
+    """
+
+    from tornado.ioloop import IOLoop
+    IOLoop.current().add_future(future, functools.partial(doc_next_tick, doc, func))
 
 
 def stream_update(source, new_data, rollover=6000):
@@ -27,7 +78,297 @@ def stream_update(source, new_data, rollover=6000):
         + rollover : amount of data to be maintained in client's browser.
     """
 
-    source.stream(new_data=new_data, rollover=rollover)
+    columns = source.data
+    dtypes  = dict((key, columns[key].dtype) for key in new_data
+                   if isinstance(columns.get(key), numpy.ndarray))
+
+    with metrics.STREAM_CALLS.time():
+        source.stream(new_data=new_data, rollover=rollover)
+
+    # Bokeh 0.12.6 sends streamed data as JSON lists whatever their dtype, so
+    # the new data is streamed as is, and the browsers cast it to their typed
+    # arrays. Here, ColumnDataSource.stream() appends it with numpy.append,
+    # which upcasts the columns: they are cast back without notifying the
+    # browsers again.
+    for key, dtype in dtypes.items():
+        if columns[key].dtype != dtype:
+            dict.__setitem__(columns, key, columns[key].astype(dtype))
+
+
+def typed_columns(data, dtypes=SAMPLE_DTYPES):
+    """Column dict of NumPy arrays, for a ColumnDataSource.
+
+    Args:
+        + data   : column dict of sequences.
+        + dtypes : dtype of each column, float64 for the others.
+
+    Return:
+        a column dict of contiguous arrays.
+    """
+
+    return dict((key, numpy.ascontiguousarray(values, dtype=dtypes.get(key, numpy.float64)))
+                for key, values in data.items())
+
+
+def concat_columns(chunks):
+    """Concatenate column dicts with the same keys.
+
+    Args:
+        + chunks : list of column dicts of lists or NumPy arrays.
+
+    Return:
+        a column dict with the concatenated columns.
+    """
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    columns = dict()
+    for key, value in chunks[0].items():
+        if isinstance(value, numpy.ndarray):
+            columns[key] = numpy.concatenate([_chunk[key] for _chunk in chunks])
+        else:
+            columns[key] = [_v for _chunk in chunks for _v in _chunk[key]]
+
+    return columns
+
+
+def minmax_decimate(new_data, buckets):
+    """Keep only the samples with the minimum and maximum force of each
+    bucket, so peaks are preserved.
+
+    Args:
+        + new_data : column dict with 'f' and 't' NumPy arrays.
+        + buckets  : non-decreasing bucket number of each sample.
+
+    Return:
+        a column dict with the kept samples, in time order.
+    """
+
+    f, t = new_data['f'], new_data['t']
+    if not t.size:
+        return new_data
+
+    starts = numpy.flatnonzero(numpy.r_[True, buckets[1:] != buckets[:-1]])
+    ends   = numpy.r_[starts[1:], buckets.size] - 1
+
+    # within each bucket, samples sorted by force: min first, max last
+    order = numpy.lexsort((f, buckets))
+    keep  = numpy.union1d(order[starts], order[ends])
+
+    return dict(f=f[keep], t=t[keep])
+
+
+class MinMaxDecimator(object):
+    """Level of detail reduction of streamed data: min/max decimation on time
+    buckets. The samples of the last bucket are held until a sample of a
+    later bucket arrives.
+
+    Args:
+        + bucket : bucket width (s), e.g. the time span of a plot pixel.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = float(bucket)
+        self.reset()
+
+    def reset(self):
+        self._pending = None
+
+    def __call__(self, new_data):
+        if self._pending is not None:
+            new_data = concat_columns([self._pending, new_data])
+
+        f = numpy.asarray(new_data['f'], dtype=numpy.float64)
+        t = numpy.asarray(new_data['t'], dtype=numpy.float64)
+
+        buckets = numpy.floor(t / self.bucket).astype(numpy.int64)
+        done    = buckets < buckets[-1] if buckets.size else buckets.astype(bool)
+
+        self._pending = dict(f=f[~done], t=t[~done])
+        return minmax_decimate(dict(f=f[done], t=t[done]), buckets[done])
+
+
+class StreamScheduler(object):
+    """Thread-safe producer/consumer buffer that coalesces new data and
+    streams it to a data source from the document's loop.
+
+    Producers (e.g. the mqtt hub's network thread) call push(). Pending data
+    is streamed 'latency' ms after the first pending sample arrives, or on
+    the next tick once 'max_size' samples are pending. Nothing is scheduled
+    while no data arrives, so an idle session never wakes the Tornado loop.
+
+    Pending data is kept as a ring buffer of at most 'rollover' samples: if
+    the loop falls behind, the oldest samples are dropped as the browser
+    would roll them over anyway.
+
+    Args:
+        + doc       : Bokeh application's curdoc().
+        + source    : Bokeh's data source object.
+        + rollover  : amount of data to be maintained in client's browser.
+        + latency   : maximum time (ms) a sample waits to be streamed.
+        + max_size  : amount of pending samples that forces a flush.
+        + capture   : CaptureBuffer keeping every pushed sample, or None.
+        + decimator : function reducing the data before streaming it
+                      (e.g. MinMaxDecimator), or None.
+
+    Functions in StreamScheduler.observers are called on each stream with
+    the scheduler and the data streamed, before decimation (see bench.py).
+    Flush sizes and lags are kept in metrics, and the samples pushed to
+    each live scheduler are rendered as 'bokeh_session_samples_total'.
+    """
+
+    observers = []
+    live      = weakref.WeakSet()
+
+    def __init__(self, doc, source, rollover=6000,
+                 latency=g.STREAM_LATENCY, max_size=g.STREAM_MAX_SIZE,
+                 capture=None, decimator=None):
+        self.doc       = doc
+        self.source    = source
+        self.rollover  = rollover
+        self.latency   = latency
+        self.max_size  = max_size
+        self.capture   = capture
+        self.decimator = decimator
+
+        self._lock   = threading.Lock()
+        self._chunks = collections.deque()
+        self._size   = 0
+        self._since  = None   # time of the oldest pending chunk
+        self._armed  = False  # a delayed flush is scheduled
+        self._eager  = False  # a next tick flush is scheduled
+        self.pushed  = 0      # samples
+
+        StreamScheduler.live.add(self)
+
+    @staticmethod
+    def _len(chunk):
+        return len(next(iter(chunk.values())))
+
+    def push(self, new_data):
+        """Add new data to be streamed. Safe to call from any thread.
+
+        Args:
+            + new_data : column dict with the source's columns.
+        """
+
+        size = self._len(new_data)
+        if not size:
+            return
+
+        if self.capture is not None:
+            self.capture.append(new_data)
+
+        with self._lock:
+            self._chunks.append(new_data)
+            self._size  += size
+            self.pushed += size
+            if self._since is None:
+                self._since = time.time()
+
+            while len(self._chunks) > 1 and \
+                  self._size - self._len(self._chunks[0]) >= self.rollover:
+                self._size -= self._len(self._chunks.popleft())
+
+            eager = self._size >= self.max_size and not self._eager
+            armed = not (self._armed or self._eager or eager)
+
+            self._eager = self._eager or eager
+            self._armed = self._armed or armed
+
+        if eager:
+            doc_next_tick(self.doc, self.flush)
+        elif armed:
+            doc_next_tick(self.doc, self._arm)
+
+    def _arm(self):
+        self.doc.add_timeout_callback(functools.partial(self.flush), self.latency)
+
+    def flush(self):
+        """Stream all pending data. Must run on the document's loop."""
+
+        with self._lock:
+            chunks = list(self._chunks)
+            since  = self._since
+            self._chunks.clear()
+            self._size  = 0
+            self._since = None
+            self._armed = False
+            self._eager = False
+
+        if not chunks:
+            return
+
+        metrics.STREAM_FLUSH_LAG.observe(time.time() - since)
+
+        data     = concat_columns(chunks)
+        new_data = data if self.decimator is None else self.decimator(data)
+
+        if self._len(new_data):
+            stream_update(self.source, new_data, self.rollover)
+
+        metrics.STREAM_FLUSH_SAMPLES.observe(self._len(data))
+
+        for observer in self.observers:
+            observer(self, data)
+
+    def clear(self):
+        """Drop all pending and captured data."""
+
+        with self._lock:
+            self._chunks.clear()
+            self._size  = 0
+            self._since = None
+
+        if self.capture is not None:
+            self.capture.clear()
+        if self.decimator is not None:
+            self.decimator.reset()
+
+    def close(self):
+        """Drop all data and stop reporting the scheduler, once its session
+        is destroyed.
+
+        Return:
+            the bytes released, about.
+        """
+
+        with self._lock:
+            released = sum(data_nbytes(chunk) for chunk in self._chunks)
+        if self.capture is not None:
+            released += self.capture.nbytes
+
+        self.clear()
+        StreamScheduler.live.discard(self)
+        return released
+
+
+def data_nbytes(data):
+    """Size (bytes) of a column dict's values, about: lists as float64
+    arrays.
+    """
+
+    return sum(values.nbytes if isinstance(values, numpy.ndarray) else 8 * len(values)
+               for values in data.values())
+
+
+def session_samples():
+    """Samples pushed to the live StreamSchedulers, by session: a metrics
+    collector, see metrics.Registry.add_collector().
+    """
+
+    counter = metrics.Counter('bokeh_session_samples_total',
+        "Samples received by each live session.", labels=('session',))
+
+    for scheduler in list(StreamScheduler.live):
+        context = scheduler.doc.session_context
+        counter.inc(scheduler.pushed, session=context.id if context else id(scheduler.doc))
+
+    return [counter]
+
+
+metrics.REGISTRY.add_collector(session_samples)
 
 
 def calibre_x_list(_list, _num=4):
@@ -71,26 +412,28 @@ def conn_status_update(conn_status, value):
     conn_status.value = value
 
 
-def device_control(client, command):
+def device_control(hub, state, command):
     """Publish a mosquitto topic with a command to control the device.
 
     Args:
-        + client  : mosquitto client object.
+        + hub     : process' MqttHub object.
+        + state   : session's SessionState object.
         + command : command to control the device.
     """
 
-    client.publish(
-        topic=g.t_device_ctrl,
-        payload=json.dumps(dict(ctrl_id=g.CTRL_ID, command=command)),
+    hub.publish(
+        topic=state.t_device_ctrl,
+        payload=json.dumps(dict(ctrl_id=state.ctrl_id, command=command)),
         qos=1,
         retain=False
     )
 
 
-def config_new_topics(topic_type):
+def config_new_topics(state, topic_type):
     """Define topics' name based on device ID.
 
     Args:
+        + state      : session's SessionState object.
         + topic_type : type of topic subscription (measure or calibration).
     """
 
@@ -106,22 +449,22 @@ def config_new_topics(topic_type):
     # t_calibration = b"device/%s/calibration" % dev_id
 
     # pub topics
-    g.t_period = str("period/%s" % g.device_id)
-    g.t_device_ctrl = str("devicectrl/%s" % g.device_id)
-    _topics.append(g.t_period)
-    _topics.append(g.t_device_ctrl)
+    state.t_period = str("period/%s" % state.device_id)
+    state.t_device_ctrl = str("devicectrl/%s" % state.device_id)
+    _topics.append(state.t_period)
+    _topics.append(state.t_device_ctrl)
 
     # sub topics
-    g.t_device_ctrl_cb = str("devicectrlcb/%s" % g.device_id)
-    _topics.append(g.t_device_ctrl_cb)
+    state.t_device_ctrl_cb = str("devicectrlcb/%s" % state.device_id)
+    _topics.append(state.t_device_ctrl_cb)
 
     if topic_type == 'measure':
-        g.t_measure = str("measure/%s" % g.device_id)
-        _topics.append(g.t_measure)
+        state.t_measure = str("measure/%s" % state.device_id)
+        _topics.append(state.t_measure)
 
     elif topic_type == 'calibration':
-        g.t_calibration = str(b"calibration/%s" % g.device_id)
-        _topics.append(g.t_calibration)
+        state.t_calibration = str(b"calibration/%s" % state.device_id)
+        _topics.append(state.t_calibration)
 
     if g.BOKEH_DEV:
         print("\nSetting topics:")
@@ -129,21 +472,41 @@ def config_new_topics(topic_type):
             print(" * %s" % topic)
 
 
-def add_subscription(client, topic_type):
+def add_subscription(hub, state, topic_type, callback, doc=None):
     """Add subscription to new mosquitto topics.
 
     Args:
-        + client     : mosquitto client object.
+        + hub        : process' MqttHub object.
+        + state      : session's SessionState object.
+        + topic_type : type of topic subscription (measure or calibration).
+        + callback   : function called with the messages of these topics.
+        + doc        : Bokeh application's curdoc() to run the callback on.
+    """
+
+    if topic_type == 'measure':
+        config_new_topics(state, 'measure')
+        hub.subscribe([state.t_measure, state.t_device_ctrl_cb], callback, doc)
+
+    elif topic_type == 'calibration':
+        config_new_topics(state, 'calibration')
+        hub.subscribe([state.t_calibration, state.t_device_ctrl_cb], callback, doc)
+
+
+def remove_subscription(hub, state, topic_type, callback):
+    """Remove subscription from the current mosquitto topics.
+
+    Args:
+        + hub        : process' MqttHub object.
+        + state      : session's SessionState object.
         + topic_type : type of topic subscription (measure or calibration).
+        + callback   : function given to add_subscription().
     """
 
     if topic_type == 'measure':
-        config_new_topics('measure')
-        client.subscribe([(g.t_measure, 1), (g.t_device_ctrl_cb, 1)])
+        hub.unsubscribe([state.t_measure, state.t_device_ctrl_cb], callback)
 
     elif topic_type == 'calibration':
-        config_new_topics('calibration')
-        client.subscribe([(g.t_calibration, 1), (g.t_device_ctrl_cb, 1)])
+        hub.unsubscribe([state.t_calibration, state.t_device_ctrl_cb], callback)
 
 
 def esp_time_diff(end, start):
@@ -1,30 +1,57 @@
 # root/app/_bokeh/views.py
 
 from flask import Blueprint, request, render_template, flash, redirect, \
-url_for, jsonify
+url_for, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 
 from app.utils.decorators import check_confirmed
-from app.utils.token import confirm_token
+from app.utils.token import confirm_token, remember_token, recall_token
 from app.models import User, Device, Calibration, Measure
 from app._bokeh import forms
+from app._bokeh.models import samples
 from app import db, app
 
 from bokeh.embed import autoload_server
 from urllib import urlencode
-from sqlalchemy import desc
-import json, uuid, datetime
+from sqlalchemy import desc, literal, tuple_
+import json, uuid, base64, datetime, io, csv, numpy
 
 
 mod = Blueprint('bokeh', __name__,
     template_folder='templates',
     static_folder='static')
 
+# measurement history pagination
+PAGE_SIZE     = 20
+MAX_PAGE_SIZE = 100
+
+# measures accepted by a single save_measurements request
+MAX_BULK_MEASURES = 500
+
+# measurement export: measures fetched per database round trip, columns
+EXPORT_BATCH_SIZE = 50
+EXPORT_COLUMNS    = ['measure_id', 'device', 'created_on', 'linear', 'angular', 'time', 'force']
+
 
 def get_user_from(token):
+    """User of a token. The user is kept with the verified token (see
+    app.utils.token), so further calls with the same token only query the
+    user's current tokens: the cache is per process, and a token rotated by
+    another process must not be accepted from a stale snapshot.
+    """
     token_dict = confirm_token(token)
     if isinstance(token_dict, dict) and 'id' in token_dict:
-        return User.query.filter_by(id=uuid.UUID(token_dict['id'])).first()
+        user_id = uuid.UUID(token_dict['id'])
+        values = recall_token(token, 'user')
+        if values:
+            _token = db.session.query(User._token).filter(User.id == user_id).scalar()
+            if _token == values['_token']:
+                return User.from_snapshot(values)
+
+        user = User.query.filter_by(id=user_id).first()
+        if user:
+            remember_token(token, user=user.snapshot())
+        return user
     return None
 
 
@@ -43,36 +70,428 @@ def get_devices_from(user):
 def get_calibrations_from(user):
     if user.using_devices:
         _using_devices = [uuid.UUID(key) for key,val in user.using_devices.iteritems()]
+        # current calibration of each device: no scan of the older ones
         return  db.session.query(
                     Calibration.id.label('c_id'),
                     Calibration.device_id.label('d_id'),
                     Device.code.label('d_code'),
                     Calibration.data.label('c_data')
                 ).\
-                distinct(Calibration.device_id).\
-                join(Calibration.device).\
-                filter(Calibration.device_id.in_(_using_devices)).\
-                order_by(Calibration.device_id, Calibration.created_on.desc()).\
+                join(Device, Device.current_calibration_id == Calibration.id).\
+                filter(Device.id.in_(_using_devices)).\
+                order_by(Device.id).\
                 all()
     return None
 
 
-def get_measurement_from(user):
-    return  db.session.query(
+def get_measurement_from(user, before=None, device=None, start=None, end=None,
+                         limit=PAGE_SIZE):
+    """Metadata of a page of the user's measurements, newest first.
+
+    Args:
+        + user   : User object.
+        + before : cursor, a (datetime, measure id) tuple: only measurements
+                   after this one, newest first.
+        + device : device code filter.
+        + start  : only measurements created on or after this datetime.
+        + end    : only measurements created before this datetime.
+        + limit  : page size.
+    """
+    query = db.session.query(
                 Device.code.label('d_code'),
                 Calibration.data.label('c_data'),
-                Measure.data.label('m_data'),
                 Measure.created_on.op('AT TIME ZONE')('UTC').label('m_date'),
+                Measure.created_on.label('m_created'),
                 Measure.id
             ).\
             join(Measure.device).\
-            join(Measure.calibration).\
-            filter_by(created_by = user.id).\
-            order_by(Measure.created_on.desc()).\
-            limit(5).\
+            join(Measure.calibration)
+
+    query = filter_measurements(query, user, device, start, end)
+    # keyset on (created_on, id): the measures of a bulk save share the
+    # same created_on, a page may end within them
+    if before: query = query.filter(
+        tuple_(Measure.created_on, Measure.id) <
+        tuple_(literal(before[0], Measure.created_on.type), literal(before[1], Measure.id.type)))
+
+    return  query.\
+            order_by(Measure.created_on.desc(), Measure.id.desc()).\
+            limit(limit).\
             all()
 
 
+def filter_measurements(query, user, device=None, start=None, end=None):
+    """Restrict a measures query to the user's measurements of a device
+    code, created from 'start' (included) to 'end' (excluded).
+    """
+    query = query.filter(Measure.created_by == user.id)
+
+    if device: query = query.filter(Device.code == device)
+    if start:  query = query.filter(Measure.created_on >= start)
+    if end:    query = query.filter(Measure.created_on < end)
+
+    return query
+
+
+def get_export_from(user, device=None, start=None, end=None):
+    """Measures to export with their device code and calibration, oldest
+    first. The rows are fetched EXPORT_BATCH_SIZE at a time through a
+    server-side cursor, so iterating over the query never loads the whole
+    result.
+    """
+    query = db.session.query(
+                Measure.id,
+                Measure.created_on.op('AT TIME ZONE')('UTC').label('m_date'),
+                Device.code.label('d_code'),
+                Calibration.data.label('c_data'),
+                Measure.samples.label('m_samples'),
+                Measure.data.label('m_data'),
+            ).\
+            join(Measure.device).\
+            join(Measure.calibration)
+
+    return  filter_measurements(query, user, device, start, end).\
+            order_by(Measure.created_on).\
+            execution_options(stream_results=True).\
+            yield_per(EXPORT_BATCH_SIZE)
+
+
+def get_measure_from(user, measure_id):
+    return  db.session.query(
+                Measure.samples.label('m_samples'),
+                Measure.data.label('m_data'),
+            ).\
+            filter(Measure.id == measure_id, Measure.created_by == user.id).\
+            first()
+
+
+def columns_from(rows):
+    """Column dict, e.g. {'id': [...], 'code': [...]}, from query rows."""
+    response = dict()
+    for row in rows:
+        for key in row.keys():
+            if not key in response: response[key] = []
+            response[key].append(getattr(row, key))
+
+    return response
+
+
+def measurement_page_from(user, **filters):
+    """get_measurement response: columns of a get_measurement_from() page
+    and the 'next' page cursor, None on the last page. Returns None if there
+    is no measurement, and empty columns for a page after the last one.
+    """
+    limit = filters.setdefault('limit', PAGE_SIZE)
+
+    # one more row tells whether there is a next page
+    filters['limit'] = limit + 1
+    measurements = get_measurement_from(user, **filters)
+
+    if measurements:
+        response  = columns_from(measurements[:limit])
+        m_created = response.pop('m_created')
+        response['next'] = page_cursor(m_created[-1], response['id'][-1]) \
+            if len(measurements) > limit else None
+
+        return response
+
+    if filters.get('before'):
+        return dict(d_code=[], c_data=[], m_date=[], id=[], next=None)
+    return None
+
+
+def measure_samples_from(user, measure_id):
+    """get_measure response, or None if the measure is not found."""
+    try:
+        measure = get_measure_from(user, uuid.UUID(measure_id))
+    except ValueError:
+        measure = None
+
+    if measure:
+        return dict(
+            id        = measure_id,
+            m_samples = samples_text_from(measure.m_samples, measure.m_data),
+        )
+    return None
+
+
+def samples_arrays_from(m_samples, m_data):
+    """(force, time) arrays of a measure row, see samples_text_from()."""
+    if m_samples is not None:
+        return samples.unpack(m_samples)
+    return numpy.asarray(m_data['force'], dtype=float), \
+           numpy.asarray(m_data['time'], dtype=float)
+
+
+def csv_number(value):
+    """CSV field of a number, as the samples are exported: empty if None."""
+    return '' if value is None else '%.6f' % float(value)
+
+
+def export_csv(rows):
+    """CSV chunks of exported measures: a header, then one chunk per
+    measure with a line per sample. Fields are quoted as needed by
+    csv.writer, e.g. device codes with commas.
+    """
+    sink   = io.BytesIO()
+    writer = csv.writer(sink, lineterminator='\n')
+
+    def _chunk():
+        value = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return value
+
+    writer.writerow(EXPORT_COLUMNS)
+    yield _chunk()
+
+    for row in rows:
+        force, time = samples_arrays_from(row.m_samples, row.m_data)
+        prefix = [str(row.id), row.d_code.encode('utf-8'), row.m_date.isoformat(),
+                  csv_number(row.c_data.get('linear')), csv_number(row.c_data.get('angular'))]
+
+        writer.writerows(prefix + ['%.6f' % _t, '%.6f' % _f]
+                         for _t, _f in zip(time.tolist(), force.tolist()))
+        yield _chunk()
+
+
+def export_arrow(rows):
+    """Arrow IPC stream chunks of exported measures: a record batch per
+    measure, with the EXPORT_COLUMNS columns.
+
+    Raise:
+        ImportError if pyarrow is not installed.
+    """
+    import pyarrow
+
+    schema = pyarrow.schema([
+        ('measure_id', pyarrow.string()),
+        ('device',     pyarrow.string()),
+        ('created_on', pyarrow.timestamp('us')),
+        ('linear',     pyarrow.float64()),
+        ('angular',    pyarrow.float64()),
+        ('time',       pyarrow.float64()),
+        ('force',      pyarrow.float64()),
+    ])
+
+    def _chunks():
+        sink   = io.BytesIO()
+        writer = pyarrow.RecordBatchStreamWriter(sink, schema)
+        for row in rows:
+            force, time = samples_arrays_from(row.m_samples, row.m_data)
+            count = len(force)
+            writer.write_batch(pyarrow.RecordBatch.from_arrays([
+                pyarrow.array([str(row.id)] * count, pyarrow.string()),
+                pyarrow.array([row.d_code] * count, pyarrow.string()),
+                pyarrow.array([row.m_date] * count, pyarrow.timestamp('us')),
+                pyarrow.array(numpy.full(count, row.c_data.get('linear'), dtype=float)),
+                pyarrow.array(numpy.full(count, row.c_data.get('angular'), dtype=float)),
+                pyarrow.array(time),
+                pyarrow.array(force),
+            ], schema=schema))
+
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+
+        writer.close()
+        yield sink.getvalue()
+
+    return _chunks()
+
+
+# format -> (chunks generator, mimetype)
+EXPORT_FORMATS = dict(
+    csv   = (export_csv, 'text/csv'),
+    arrow = (export_arrow, 'application/vnd.apache.arrow.stream'),
+)
+
+
+def parse_datetime(value):
+    """Parse an ISO formatted date or datetime used in query arguments."""
+    for _format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, _format)
+        except ValueError:
+            pass
+
+    raise ValueError("'%s' is not an ISO formatted date." % value)
+
+
+def page_cursor(created_on, measure_id):
+    """'next' cursor of a measurement page, from its last measure."""
+    return '%s_%s' % (created_on.isoformat(), measure_id)
+
+
+def parse_cursor(value):
+    """(datetime, measure id) tuple of a page_cursor()."""
+    created_on, _, measure_id = value.rpartition('_')
+    return parse_datetime(created_on), uuid.UUID(measure_id)
+
+
+def measurement_filters_from(args):
+    """get_measurement_from() arguments from the request query arguments:
+    'before' (cursor), 'device', 'start', 'end' and 'limit'.
+    """
+    filters = dict(device=args.get('device'))
+    for key in ['start', 'end']:
+        if args.get(key):
+            filters[key] = parse_datetime(args.get(key))
+    if args.get('before'):
+        filters['before'] = parse_cursor(args.get('before'))
+
+    filters['limit'] = min(int(args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+    if filters['limit'] < 1:
+        raise ValueError("'limit' must be a positive number.")
+
+    return filters
+
+
+def samples_from(data):
+    """Packed samples blob from a measure posted by the Bokeh apps, which
+    may send it already packed and base64 encoded ('s') or as force and time
+    lists ('f' and 't'). Returns None if the samples are missing or invalid.
+    """
+    try:
+        if 's' in data:
+            force, time = samples.loads(data['s'])
+        elif 'f' in data and 't' in data:
+            force, time = data['f'], data['t']
+        else:
+            return None
+
+        return samples.pack(force, time)
+
+    except (TypeError, ValueError):
+        return None
+
+
+def calibration_mapping_from(data, user):
+    """Calibration column values from a calibration posted by the Bokeh
+    calibration app: a dict with 'd_id', 'lin' and 'ang'.
+
+    Raise:
+        ValueError if the calibration is incomplete.
+    """
+    if not isinstance(data, dict) or \
+       not ('lin' in data and 'ang' in data and 'd_id' in data):
+        raise ValueError("missing 'd_id', 'lin' or 'ang'.")
+
+    return dict(
+        device_id = data['d_id'],
+        data = dict(
+            linear  = data['lin'],
+            angular = data['ang'],
+        ),
+        created_by = user.id,
+        updated_by = user.id,
+    )
+
+
+def add_calibration(mapping):
+    """Add a calibration and make it the current one of its device, in the
+    same transaction.
+
+    Args:
+        + mapping : calibration column values (see calibration_mapping_from()).
+    """
+    calibration = Calibration(**mapping)
+    db.session.add(calibration)
+    db.session.flush()
+
+    Device.query.\
+        filter_by(id=calibration.device_id).\
+        update(dict(current_calibration_id=calibration.id), synchronize_session=False)
+
+    return calibration
+
+
+def measure_mapping_from(data, user):
+    """Measure column values from a measure posted by the Bokeh apps.
+
+    Args:
+        + data : dict with 'd_id', 'c_id' and the samples (see samples_from()).
+        + user : User saving the measure.
+
+    Return:
+        a dict for Measure(**mapping) or bulk_insert_mappings().
+
+    Raise:
+        ValueError if the measure is incomplete or corrupted.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("measure must be an object.")
+
+    _samples = samples_from(data)
+    if not _samples:
+        raise ValueError("missing or invalid samples.")
+
+    try:
+        return dict(
+            id             = uuid.uuid4(),
+            device_id      = uuid.UUID(data['d_id']),
+            calibration_id = uuid.UUID(data['c_id']),
+            samples        = _samples,
+            created_by     = user.id,
+            updated_by     = user.id,
+        )
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise ValueError("missing or invalid 'd_id' or 'c_id'.")
+
+
+def posted_measures():
+    """Measures of a save_measurements request: a JSON list or a NDJSON
+    body (one measure per line), which is read as it is streamed.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        for line in request.stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        _data = request.get_json(force=True, silent=True)
+        if not isinstance(_data, list):
+            raise ValueError("body must be a list of measures.")
+        for item in _data:
+            yield item
+
+
+def samples_text_from(m_samples, m_data):
+    """Base64 packed samples of a measure row, packing the legacy JSON lists
+    of rows saved before the samples column existed.
+    """
+    if m_samples is not None:
+        return base64.b64encode(bytes(m_samples)).decode('ascii')
+    return samples.dumps(m_data['force'], m_data['time'])
+
+
+def bokeh_script(app_path):
+    """Autoload script of a Bokeh app for the current user. The user's bokeh
+    token is reused while it is valid for more than TOKEN_RENEW_FRACTION of
+    TOKEN_EXPIRES_IN, so page views do not write to the users table and a
+    page always gets a token valid for a long capture session.
+    """
+    token = current_user.reuse_token(
+        expiration     = app.config['TOKEN_EXPIRES_IN'],
+        token_type     = 'bokeh',
+        renew_fraction = app.config['TOKEN_RENEW_FRACTION'],
+    )
+    _request = urlencode(dict(token=token))
+    return autoload_server(model=None, app_path=app_path, request=_request,
+                           url=bokeh_url_for(current_user))
+
+
+def bokeh_url_for(user):
+    """URL of the Bokeh server process of a user. All the sessions of a
+    user, and so of their devices, go to the same process, whatever Flask
+    process serves the page.
+    """
+    worker = user.id.int % max(app.config['BOKEH_WORKERS'], 1)
+    return '%s:%d' % (app.config['BOKEH_URL'], app.config['BOKEH_PORT'] + worker)
+
+
 @mod.route('/home/')
 @mod.route('/', alias=True)
 @login_required
@@ -123,13 +542,7 @@ def get_devices(token):
     if user and user.has_valid_token(token, token_type='bokeh'):
         devices = get_devices_from(user)
         if devices:
-            response = dict()
-            for row in devices:
-                for key in row.keys():
-                    if not key in response: response[key] = []
-                    response[key].append(getattr(row, key))
-
-            return jsonify(response)
+            return jsonify(columns_from(devices))
 
     flash("The token used here may be invalid or expired, "
           "or you have not registered any device to use.", 'danger')
@@ -140,31 +553,20 @@ def get_devices(token):
 @login_required
 @check_confirmed
 def calibration():
-    token = current_user.generate_token(
-        expiration = app.config['TOKEN_EXPIRES_IN'],
-        token_type = 'bokeh'
-    )
-    _request = urlencode(dict(token=token))
-    script   = autoload_server(model=None, app_path="/_calibre", request=_request)
-    return render_template('_bokeh/base_bokeh.html', bokeh_script=script)
+    return render_template('_bokeh/base_bokeh.html', bokeh_script=bokeh_script("/_calibre"))
 
 
 @mod.route('/save_calibration/<token>/', methods=['POST'])
 def save_calibration(token):
     user = get_user_from(token)
     if user and user.has_valid_token(token, token_type='bokeh'):
-        _data = request.get_json(force=True)
-        if 'lin' in _data and 'ang' in _data and 'd_id' in _data:
-            calibration = Calibration(
-                device_id = _data['d_id'],
-                data = dict(
-                    linear  = _data['lin'],
-                    angular = _data['ang'],
-                ),
-                created_by = user.id,
-                updated_by = user.id,
-            )
-            db.session.add(calibration)
+        try:
+            mapping = calibration_mapping_from(request.get_json(force=True), user)
+        except ValueError:
+            mapping = None
+
+        if mapping:
+            add_calibration(mapping)
             db.session.commit()
 
             # Calibration successfully saved
@@ -181,13 +583,7 @@ def get_calibrations(token):
     if user and user.has_valid_token(token, token_type='bokeh'):
         calibrations = get_calibrations_from(user)
         if calibrations:
-            response = dict()
-            for row in calibrations:
-                for key in row.keys():
-                    if not key in response: response[key] = []
-                    response[key].append(getattr(row, key))
-
-            return jsonify(response)
+            return jsonify(columns_from(calibrations))
 
     flash("The token used here may be invalid or expired, "
           "or you have not registered any device to use.", 'danger')
@@ -198,32 +594,19 @@ def get_calibrations(token):
 @login_required
 @check_confirmed
 def measurement():
-    token = current_user.generate_token(
-        expiration = app.config['TOKEN_EXPIRES_IN'],
-        token_type = 'bokeh'
-    )
-    _request = urlencode(dict(token=token))
-    script   = autoload_server(model=None, app_path="/_measure", request=_request)
-    return render_template('_bokeh/base_bokeh.html', bokeh_script=script)
+    return render_template('_bokeh/base_bokeh.html', bokeh_script=bokeh_script("/_measure"))
 
 
 @mod.route('/save_measurement/<token>/', methods=['POST'])
 def save_measurement(token):
     user = get_user_from(token)
     if user and user.has_valid_token(token, token_type='bokeh'):
-        _data = request.get_json(force=True)
-        if 'f' in _data and 't' in _data and \
-        'd_id' in _data and 'c_id' in _data:
-            measure = Measure(
-                device_id      = _data['d_id'],
-                calibration_id = _data['c_id'],
-                data = dict(
-                    force = _data['f'],
-                    time  = _data['t'],
-                ),
-                created_by = user.id,
-                updated_by = user.id,
-            )
+        try:
+            measure = Measure(**measure_mapping_from(request.get_json(force=True), user))
+        except ValueError:
+            measure = None
+
+        if measure:
             db.session.add(measure)
             db.session.commit()
 
@@ -235,18 +618,71 @@ def save_measurement(token):
     return 'saving_error'
 
 
+@mod.route('/save_measurements/<token>/', methods=['POST'])
+def save_measurements(token):
+    """Save a batch of measures (a JSON list or NDJSON body) in a single
+    transaction. The token is validated once for the whole batch, and the
+    response reports the status of each measure:
+        {"saved": <count>, "items": [{"status": "saved", "id": <id>} or
+                                     {"status": "error", "error": <msg>}]}
+    """
+    user = get_user_from(token)
+    if not (user and user.has_valid_token(token, token_type='bokeh')):
+        return jsonify(dict(error="invalid or expired token")), 401
+
+    items    = []
+    mappings = []
+    try:
+        for _data in posted_measures():
+            if len(items) == MAX_BULK_MEASURES:
+                return jsonify(dict(error="more than %d measures" % MAX_BULK_MEASURES)), 413
+
+            try:
+                mappings.append(measure_mapping_from(_data, user))
+                items.append(dict(status='saved', id=str(mappings[-1]['id'])))
+            except ValueError as e:
+                mappings.append(None)
+                items.append(dict(status='error', error=str(e)))
+
+    except ValueError as e:
+        return jsonify(dict(error=str(e))), 400
+
+    # check all the calibrations with a single query, so a bad reference
+    # fails only its own measure instead of the whole transaction
+    _c_ids = set(_m['calibration_id'] for _m in mappings if _m)
+    calibrations = dict(
+        db.session.query(Calibration.id, Calibration.device_id).\
+        filter(Calibration.id.in_(_c_ids)).\
+        all()
+    ) if _c_ids else dict()
+
+    for index, _m in enumerate(mappings):
+        if _m and calibrations.get(_m['calibration_id']) != _m['device_id']:
+            mappings[index] = None
+            items[index] = dict(status='error', error="unknown device or calibration.")
+
+    mappings = [_m for _m in mappings if _m]
+    if mappings:
+        db.session.bulk_insert_mappings(Measure, mappings)
+        db.session.commit()
+
+    return jsonify(dict(saved=len(mappings), items=items))
+
+
 @mod.route('/get_measurement/<token>/')
 def get_measurement(token):
+    """Page of the user's measurements metadata. The 'next' cursor must be
+    sent as the 'before' argument to get the following page.
+    """
     user = get_user_from(token)
     if user and user.has_valid_token(token, token_type='bokeh'):
-        measurements = get_measurement_from(user)
-        if measurements:
-            response = dict()
-            for row in measurements:
-                for key in row.keys():
-                    if not key in response: response[key] = []
-                    response[key].append(getattr(row, key))
+        try:
+            filters = measurement_filters_from(request.args)
+        except ValueError:
+            filters = None
 
+        response = filters and measurement_page_from(user, **filters)
+        if response:
             return jsonify(response)
 
     flash("The token used here may be invalid or expired, "
@@ -254,14 +690,53 @@ def get_measurement(token):
     return 'not_ok'
 
 
+@mod.route('/get_measure/<token>/<measure_id>/')
+def get_measure(token, measure_id):
+    """Packed samples of a single measurement."""
+    user = get_user_from(token)
+    if user and user.has_valid_token(token, token_type='bokeh'):
+        response = measure_samples_from(user, measure_id)
+        if response:
+            return jsonify(response)
+
+    flash("The token used here may be invalid or expired, "
+          "or the measurement does not exist.", 'danger')
+    return 'not_ok'
+
+
+@mod.route('/export_measurements/')
+@login_required
+@check_confirmed
+def export_measurements():
+    """Download the user's measurements, a line per sample with the
+    calibration of the measure, as CSV or as an Arrow stream ('format'
+    argument). The 'device', 'start' and 'end' arguments filter the
+    measurements as in get_measurement. The response is streamed as the
+    rows are fetched, so large exports are never held in memory.
+    """
+    _format = request.args.get('format', 'csv')
+    try:
+        filters = dict(device=request.args.get('device'))
+        for key in ['start', 'end']:
+            if request.args.get(key):
+                filters[key] = parse_datetime(request.args.get(key))
+
+        chunks, mimetype = EXPORT_FORMATS[_format]
+        chunks = chunks(get_export_from(current_user, **filters))
+    except (KeyError, ValueError):
+        return jsonify(dict(error="invalid format, start or end date.")), 400
+    except ImportError:
+        return jsonify(dict(error="'%s' export is not available." % _format)), 501
+
+    filename = 'measurements__%s.%s' % (
+        datetime.datetime.utcnow().strftime('%Y_%m_%dT%H_%M_%S'), _format)
+
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
 @mod.route('/plot_measures/')
 @login_required
 @check_confirmed
 def plot_measures():
-    token = current_user.generate_token(
-        expiration = app.config['TOKEN_EXPIRES_IN'],
-        token_type = 'bokeh'
-    )
-    _request = urlencode(dict(token=token))
-    script   = autoload_server(model=None, app_path="/_plot", request=_request)
-    return render_template('_bokeh/base_bokeh.html', bokeh_script=script)
+    return render_template('_bokeh/base_bokeh.html', bokeh_script=bokeh_script("/_plot"))
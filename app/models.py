@@ -1,15 +1,18 @@
 # root/app/models.py
 
-from app import db, bcrypt
-from app.utils.token import generate_token, confirm_token
+from app import app, db, hasher
+from app.utils.cache import TTLCache
+from app.utils.token import generate_token, confirm_token, forget_token, token_expires_in
 
 from flask_login import current_user
 
+from sqlalchemy import event, inspect
 from sqlalchemy.dialects.postgresql import UUID, JSON, ARRAY
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import make_transient_to_detached
 
-import uuid
+import copy, uuid
 
 
 # Associate MutableDict with all future instances of JSON
@@ -46,6 +49,10 @@ class BaseUser(Base):
         return db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), default=current_user_id, onupdate=current_user_id)
 
 
+# user snapshots by id, see User.get_cached()
+_user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -128,10 +135,19 @@ class User(Base):
 
     @password.setter
     def password(self, password):
-        self._password = bcrypt.generate_password_hash(password)
+        self._password = hasher.hash(password)
 
     def has_password_equal_to(self, password):
-        return bcrypt.check_password_hash(self._password, password)
+        if not hasher.check(self._password, password):
+            return False
+
+        # the password is known: rehash it if the configured cost changed
+        if hasher.needs_rehash(self._password):
+            self.password = password
+            db.session.add(self)
+            db.session.commit()
+
+        return True
 
     def raise_if_no_attr(self, attr):
         if not hasattr(self, attr):
@@ -172,6 +188,8 @@ class User(Base):
                 if self._token is None:
                     self._token = {str(token_type): _token}
                 else:
+                    # the rotated token is no longer valid
+                    forget_token(self._token.get(str(token_type)))
                     self._token.update({str(token_type): _token})
 
                 db.session.add(self)
@@ -182,6 +200,52 @@ class User(Base):
         except (TypeError, AttributeError) as e:
             raise e
 
+    def reuse_token(self, expiration, token_type, renew_fraction=0.5):
+        """Current token of a type, if it is still valid for more than
+        'renew_fraction' of 'expiration' hours, with no database write.
+        Otherwise a new one is generated (see generate_token()).
+        """
+        if self._token and token_type in self._token:
+            _token = self._token[token_type]
+            if token_expires_in(_token) > renew_fraction * expiration * 3600 and \
+               self.cast(self.id, confirm_token(_token).get('id')) == self.id:
+                return _token
+
+        return self.generate_token(expiration, token_type)
+
+    def forget_tokens(self):
+        """Drop the user's tokens, and the user snapshots kept with them,
+        from the verified tokens cache. Must be called when the user changes.
+        """
+        for _token in (self._token or {}).values():
+            forget_token(_token)
+
+    @classmethod
+    def get_cached(cls, user_id):
+        """User by id, rebuilt from a snapshot with no query while it is
+        cached (up to USER_CACHE_TTL seconds, or until the user changes).
+        """
+        values = _user_cache.get(user_id)
+        if values:
+            return cls.from_snapshot(values)
+
+        user = cls.query.get(user_id)
+        if user:
+            _user_cache.set(user_id, user.snapshot())
+        return user
+
+    def snapshot(self):
+        """Column values of the user, to rebuild it with from_snapshot()."""
+        return dict((attr.key, copy.deepcopy(getattr(self, attr.key)))
+                    for attr in inspect(self).mapper.column_attrs)
+
+    @classmethod
+    def from_snapshot(cls, values):
+        """User from a snapshot(), added to the session without a query."""
+        user = cls(**copy.deepcopy(values))
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def has_valid_token(self, token, token_type, token_key=None):
         try:
             if token_type:
@@ -222,20 +286,41 @@ class User(Base):
             return None
 
 
+@event.listens_for(db.session, 'after_flush')
+def forget_changed_users(session, flush_context):
+    """Drop the cached snapshots of the users written by a flush."""
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            _user_cache.pop(obj.id)
+            obj.forget_tokens()
+
+
 class Device(BaseUser):
     __tablename__ = 'devices'
 
     code        = db.Column(db.String(32), nullable=False, unique=True)
 
+    # latest calibration, updated together with each new calibration
+    current_calibration_id = db.Column(UUID(as_uuid=True), db.ForeignKey('calibrations.id',
+                             use_alter=True, name='fk_devices_current_calibration_id'), nullable=True)
+
     calibration = db.relationship('Calibration', backref='device', lazy='dynamic', foreign_keys="Calibration.device_id")
     measures    = db.relationship('Measure', backref='device', lazy='dynamic', foreign_keys="Measure.device_id")
 
+    current_calibration = db.relationship('Calibration', foreign_keys=[current_calibration_id], post_update=True)
+
     def __repr__(self):
         return '<Device:{}>'.format(self.code)
 
 
+# Composite indexes on (<filter column>, created_on) also serve the
+# "ORDER BY created_on DESC" queries, as Postgres scans them backwards.
+
 class Calibration(BaseUser):
-    __tablename__ = 'calibrations'
+    __tablename__  = 'calibrations'
+    __table_args__ = (
+        db.Index('ix_calibrations_device_id_created_on', 'device_id', 'created_on'),
+    )
 
     device_id   = db.Column(UUID(as_uuid=True), db.ForeignKey('devices.id'), nullable=False)
     data        = db.Column(JSON, nullable=False)
@@ -247,11 +332,16 @@ class Calibration(BaseUser):
 
 
 class Measure(BaseUser):
-    __tablename__ = 'measures'
+    __tablename__  = 'measures'
+    __table_args__ = (
+        db.Index('ix_measures_created_by_created_on_id', 'created_by', 'created_on', 'id'),
+        db.Index('ix_measures_device_id_created_on', 'device_id', 'created_on'),
+    )
 
     device_id      = db.Column(UUID(as_uuid=True), db.ForeignKey('devices.id'), nullable=False)
     calibration_id = db.Column(UUID(as_uuid=True), db.ForeignKey('calibrations.id'), nullable=False)
-    data           = db.Column(JSON, nullable=False)
+    data           = db.Column(JSON, nullable=True)          # legacy "%.6f" string lists
+    samples        = db.Column(db.LargeBinary, nullable=True) # see app/_bokeh/models/samples.py
 
     def __repr__(self):
         return '<Measure:{}>'.format(self.id)
@@ -4,7 +4,7 @@ from flask import Blueprint, request, render_template, flash, redirect, url_for
 from flask_login import login_user, logout_user, login_required, current_user,\
 fresh_login_required, login_fresh
 
-from app.utils.decorators import check_confirmed
+from app.utils.decorators import check_confirmed, catch_hash_timeout
 from app.utils.email import send_email
 from app.models import User
 from app.user import forms
@@ -52,6 +52,7 @@ def index():
 
 
 @mod.route('/login/', methods=['GET', 'POST'])
+@catch_hash_timeout
 def login():
     # login_dev_user() # FOR_DEV
 
@@ -83,6 +84,7 @@ def logout():
 
 
 @mod.route('/register/', methods=['GET', 'POST'])
+@catch_hash_timeout
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('.index'))
@@ -190,6 +192,7 @@ def request_password_reset():
 
 
 @mod.route('/reset/<token>/', methods=['GET', 'POST'])
+@catch_hash_timeout
 def password_reset(token):
     if not current_user.is_anonymous:
         return redirect(url_for('.index'))
@@ -252,6 +255,7 @@ def my_info():
 @mod.route('/change-email/', methods=['GET', 'POST'])
 @fresh_login_required
 @check_confirmed
+@catch_hash_timeout
 def request_change_email():
     form = forms.ChangeEmailForm()
     if form.validate_on_submit():
@@ -291,6 +295,7 @@ def change_email(token):
 @mod.route('/change-password/', methods=['GET', 'POST'])
 @fresh_login_required
 @check_confirmed
+@catch_hash_timeout
 def change_password():
     form = forms.ChangePasswordForm()
     if form.validate_on_submit():
@@ -0,0 +1,53 @@
+# root/app/utils/cache.py
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache(object):
+    """Thread-safe, size bounded (least recently used first out) cache whose
+    entries expire 'ttl' seconds after being set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self._data   = OrderedDict()  # key -> (expires_on, value)
+        self._lock   = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+
+            if item[0] <= time.time():
+                return default
+
+            self._data[key] = item
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
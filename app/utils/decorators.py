@@ -1,8 +1,9 @@
 # root/app/utils/decorators.py
 
 from functools import wraps
+from multiprocessing import TimeoutError
 
-from flask import flash, redirect, url_for
+from flask import flash, redirect, request, url_for
 from flask_login import current_user
 
 
@@ -15,3 +16,19 @@ def check_confirmed(func):
         return func(*args, **kwargs)
 
     return decorated_function
+
+
+def catch_hash_timeout(func):
+    """Redirect back to the page with a "try again" message when a password
+    hash waits longer than PASSWORD_TIMEOUT (see app/utils/password.py),
+    e.g. on a burst of logins, instead of failing with a server error.
+    """
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except TimeoutError:
+            flash('The server is busy, please try again in a moment.', 'warning')
+            return redirect(request.url)
+
+    return decorated_function
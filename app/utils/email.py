@@ -2,13 +2,149 @@
 
 from flask import current_app, render_template
 from flask_mail import Message
-from app import mail
+from app import mail, app
 from threading import Thread
+import atexit, smtplib, socket, time
 
+try:
+    # Python 2.7
+    from Queue import Queue, Empty
+except ImportError:
+    # Python 3
+    from queue import Queue, Empty
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+class MailDispatcher(object):
+    """Send emails from a bounded queue with a fixed pool of worker threads.
+
+    Each worker keeps its SMTP connection open while messages keep coming
+    (up to MAIL_IDLE_TIMEOUT seconds between them), so a burst of emails is
+    sent through a few connections. Failed sends are retried MAIL_RETRIES
+    times with an exponential backoff starting at MAIL_RETRY_DELAY seconds.
+
+    Workers are started by the first send(), and flushed and stopped at
+    exit. To try it locally, run a debugging SMTP server:
+        $ python -m smtpd -n -c DebuggingServer localhost:1025
+    and set APP_MAIL_SERVER=localhost, APP_MAIL_PORT=1025 and
+    APP_MAIL_USE_SSL=false (TestingConfig does so).
+    """
+
+    _STOP = object()
+
+    def __init__(self, app=None, mail=None):
+        self.workers = []
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        self.app          = app
+        self.mail         = mail
+        self.n_workers    = app.config.get('MAIL_WORKERS', 2)
+        self.retries      = app.config.get('MAIL_RETRIES', 3)
+        self.retry_delay  = app.config.get('MAIL_RETRY_DELAY', 1.)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 2.)
+        self.queue        = Queue(maxsize=app.config.get('MAIL_QUEUE_SIZE', 100))
+
+        atexit.register(self.shutdown)
+
+    def start(self):
+        if self.workers:
+            return
+
+        for i in range(self.n_workers):
+            worker = Thread(target=self._work, name='mail-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def send(self, msg, timeout=None):
+        """Queue a message. Blocks up to 'timeout' seconds (forever if None)
+        while the queue is full, then raises Queue.Full.
+        """
+        self.start()
+        self.queue.put(msg, timeout=timeout)
+
+    def flush(self, timeout=None):
+        """Wait until the queued messages are sent or dropped.
+
+        Return:
+            True if the queue was flushed within 'timeout' seconds.
+        """
+        done = self.queue.all_tasks_done
+        end  = None if timeout is None else time.time() + timeout
+
+        with done:
+            while self.queue.unfinished_tasks:
+                if end is None:
+                    done.wait()
+                elif end - time.time() <= 0:
+                    return False
+                else:
+                    done.wait(end - time.time())
+        return True
+
+    def shutdown(self, timeout=None):
+        """Flush the queue and stop the workers."""
+        if not self.workers:
+            return
+
+        self.flush(timeout)
+        for worker in self.workers:
+            self.queue.put(self._STOP)
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def _work(self):
+        with self.app.app_context():
+            msg = self.queue.get()
+            while msg is not self._STOP:
+                msg = self._send_burst(msg)
+            self.queue.task_done()
+
+    def _send_burst(self, msg):
+        """Send a message, and the next queued ones through the same
+        connection. Return the next message once the queue gets idle.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.mail.connect() as conn:
+                    while True:
+                        conn.send(msg)
+                        self.queue.task_done()
+                        msg, attempt = None, 0
+
+                        try:
+                            msg = self.queue.get(timeout=self.idle_timeout)
+                        except Empty:
+                            break
+
+                        if msg is self._STOP:
+                            return msg
+
+            except (smtplib.SMTPException, socket.error) as e:
+                if msg is not None and attempt < self.retries:
+                    attempt += 1
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                    continue
+                error = e
+
+            except Exception as e:
+                # invalid message, not worth retrying
+                error = e
+
+            else:
+                return self.queue.get()
+
+            if msg is not None:
+                self.app.logger.error("Mail to %s not sent: %s" % (msg.recipients, error))
+                self.queue.task_done()
+
+            return self.queue.get()
+
+
+dispatcher = MailDispatcher(app, mail)
 
 
 def send_email(to, subject, template, **kwargs):
@@ -19,6 +155,4 @@ def send_email(to, subject, template, **kwargs):
         html       = render_template(template, **kwargs),
         sender     = app.config['MAIL_DEFAULT_SENDER']
     )
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    dispatcher.send(msg)
@@ -0,0 +1,53 @@
+# root/app/utils/metrics.py
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app._bokeh.models import metrics
+import time
+
+
+class FlaskMetrics(object):
+    """Latency and database query count of each request, by endpoint.
+
+    They are rendered on '/metrics' in the Prometheus text format, with the
+    other metrics of this process (see app/_bokeh/models/metrics.py). Must
+    be created before the other before_request functions, so their time is
+    counted too.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+        event.listen(Engine, 'before_cursor_execute', self._count_query)
+
+    @staticmethod
+    def _before():
+        g._metrics_start   = time.time()
+        g._metrics_queries = 0
+
+    @staticmethod
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and hasattr(g, '_metrics_queries'):
+            g._metrics_queries += 1
+
+    @staticmethod
+    def _after(response):
+        if hasattr(g, '_metrics_start'):
+            endpoint = request.endpoint or 'not_found'
+
+            metrics.HTTP_REQUESTS.observe(time.time() - g._metrics_start,
+                endpoint=endpoint, method=request.method, status=response.status_code)
+            metrics.DB_QUERIES.observe(g._metrics_queries, endpoint=endpoint)
+
+        return response
+
+    @staticmethod
+    def view():
+        return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
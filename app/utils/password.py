@@ -0,0 +1,102 @@
+# root/app/utils/password.py
+
+from multiprocessing import Pool, cpu_count
+from threading import Lock
+import atexit, bcrypt, hmac, math, os, time
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(pw_hash, password):
+    return hmac.compare_digest(bcrypt.hashpw(password, pw_hash), pw_hash)
+
+
+class PasswordHasher(object):
+    """bcrypt hashing on a pool of processes.
+
+    Hashes are computed out of the web server process: waiting views do not
+    hold the GIL, and a burst of logins queues on PASSWORD_POOL_SIZE
+    processes instead of taking every worker thread's CPU.
+
+    The cost is BCRYPT_LOG_ROUNDS, the same for every process: calibrate it
+    once per machine with `manage.py calibrate_bcrypt` (see
+    calibrate_rounds()) and set it in the config. A hash waiting more than
+    PASSWORD_TIMEOUT seconds raises multiprocessing.TimeoutError (see
+    decorators.catch_hash_timeout()).
+    """
+
+    def __init__(self, app=None):
+        self._pool = None
+        self._pid  = None
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds    = app.config['BCRYPT_LOG_ROUNDS']
+        self.processes = app.config.get('PASSWORD_POOL_SIZE') or cpu_count()
+        self.timeout   = app.config['PASSWORD_TIMEOUT']
+
+        atexit.register(self.close)
+
+    @property
+    def pool(self):
+        # a forked process (e.g. the reloader) must not use its parent's pool
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = Pool(self.processes)
+                self._pid  = os.getpid()
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+    def _run(self, func, *args):
+        return self.pool.apply_async(func, args).get(self.timeout)
+
+    def hash(self, password, rounds=None):
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self._run(_hash, _bytes(password), rounds or self.rounds)
+
+    def check(self, pw_hash, password):
+        return self._run(_check, _bytes(pw_hash), _bytes(password))
+
+    @staticmethod
+    def rounds_of(pw_hash):
+        # "$2b$<rounds>$<salt and hash>"
+        try:
+            return int(_bytes(pw_hash).split(b'$')[2])
+        except (IndexError, ValueError):
+            return None
+
+    def needs_rehash(self, pw_hash):
+        # only upgraded: a hash of a higher cost is kept
+        rounds = self.rounds_of(pw_hash)
+        return rounds is None or rounds < self.rounds
+
+    def calibrate_rounds(self, target_ms, probe_rounds=8, min_rounds=4, max_rounds=31,
+                         repeat=5):
+        """Cost whose hashing time is the closest to 'target_ms' (ms). Each
+        round doubles the hashing time, so it is only measured at
+        'probe_rounds', the best of 'repeat' times.
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            self.pool.apply_async(_hash, (b'calibration', probe_rounds)).get(self.timeout)
+            timings.append(time.time() - start)
+        elapsed_ms = min(timings) * 1e3
+
+        rounds = probe_rounds + int(round(math.log(float(target_ms) / elapsed_ms, 2)))
+        return max(min_rounds, min(rounds, max_rounds))
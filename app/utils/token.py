@@ -1,18 +1,97 @@
 # root/app/utils/token.py
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from app.utils.cache import TTLCache
 from app import app
 
+import hashlib, hmac, time
+
+
+# serializers by expiration, they are thread-safe and can be reused
+_serializers = dict()
+
+# verified tokens, by token digest: dict(payload, exp[, user])
+_verified = TTLCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _copy(payload):
+    return dict(payload) if isinstance(payload, dict) else payload
+
+
+def get_serializer(expiration=None):
+    s = _serializers.get(expiration)
+    if s is None:
+        s = Serializer(app.config['SECRET_KEY'], expiration*3600 if expiration else None)
+        s = _serializers.setdefault(expiration, s)
+    return s
+
+
+def token_digest(token):
+    return hmac.new(_bytes(app.config['SECRET_KEY']), _bytes(token), hashlib.sha256).digest()
+
 
 def generate_token(data, expiration=1):
-    s = Serializer(app.config['SECRET_KEY'], expiration*3600)
+    s = get_serializer(expiration)
     return s.dumps(data, salt=app.config['SECURITY_PASSWORD_SALT'])
 
 
-def confirm_token(token):
-    s = Serializer(app.config['SECRET_KEY'])
+def _verify(token):
+    try:
+        key = token_digest(token)
+    except (TypeError, AttributeError):
+        return None
+
+    entry = _verified.get(key)
+    if entry and entry['exp'] > time.time():
+        return entry
+
+    s = get_serializer()
     try:
-        data = s.loads(token, salt=app.config['SECURITY_PASSWORD_SALT'])
-        return data
+        data, header = s.loads(token, salt=app.config['SECURITY_PASSWORD_SALT'],
+                               return_header=True)
     except:
+        return None
+
+    entry = dict(payload=data, exp=header['exp'])
+    _verified.set(key, entry, ttl=header['exp'] - time.time())
+    return entry
+
+
+def confirm_token(token):
+    entry = _verify(token)
+    if entry is None:
         return False
+    return _copy(entry['payload'])
+
+
+def token_expires_in(token):
+    """Seconds until a token expires, 0 if it is invalid or expired."""
+    entry = _verify(token)
+    if entry is None:
+        return 0
+    return max(entry['exp'] - time.time(), 0)
+
+
+def remember_token(token, **values):
+    """Keep values with a verified token (e.g. the user it was checked
+    against) until it expires or is forgotten.
+    """
+    entry = _verified.get(token_digest(token))
+    if entry:
+        entry.update(values)
+
+
+def recall_token(token, key):
+    entry = _verified.get(token_digest(token))
+    if entry and entry['exp'] > time.time():
+        return entry.get(key)
+    return None
+
+
+def forget_token(token):
+    if token:
+        _verified.pop(token_digest(token))
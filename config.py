@@ -33,8 +33,13 @@ class BaseConfig(object):
     SECURITY_PASSWORD_SALT       = 'my_precious_two'
     WTF_CSRF_SECRET_KEY          = 'my_precious_three'
     WTF_CSRF_ENABLED             = True
-    BCRYPT_LOG_ROUNDS            = 13    # 4 <= BCRYPT_LOG_ROUNDS <= 31
+    BCRYPT_LOG_ROUNDS            = 13    # 4 <= BCRYPT_LOG_ROUNDS <= 31, see manage.py calibrate_bcrypt
+    PASSWORD_POOL_SIZE           = None  # hashing processes, default: number of CPUs
+    PASSWORD_TIMEOUT             = 30    # in seconds, a hash waits for the pool at most this long
     TOKEN_EXPIRES_IN             = int(os.environ.get('APP_TOKEN_EXPIRES_IN', '48')) # in hours
+    TOKEN_RENEW_FRACTION         = 0.5   # renew reused tokens below this part of TOKEN_EXPIRES_IN
+    TOKEN_CACHE_SIZE             = 1024  # verified tokens kept in memory
+    TOKEN_CACHE_TTL              = 300   # in seconds, users changed by another process stay cached this long
     THREADS_PER_PAGE             = 2
     DEBUG                        = False
     DEBUG_TB_ENABLED             = False
@@ -44,6 +49,15 @@ class BaseConfig(object):
     USE_SESSION_FOR_NEXT         = True
     PERMANENT_SESSION_LIFETIME   = datetime.timedelta(hours=8)
     REMEMBER_COOKIE_DURATION     = datetime.timedelta(days=30)
+    SESSION_REFRESH_EACH_REQUEST = False
+    SESSION_REFRESH_WITHIN       = datetime.timedelta(hours=1) # cookie reissued this close to its expiration
+    USER_CACHE_SIZE              = 1024  # users kept in memory
+    USER_CACHE_TTL               = 60    # in seconds
+
+    # bokeh server processes, a user's sessions always go to the same one
+    BOKEH_URL                    = os.environ.get('BOKEH_URL', 'http://localhost')
+    BOKEH_PORT                   = int(os.environ.get('BOKEH_PORT', '5006'))  # port of the first process
+    BOKEH_WORKERS                = int(os.environ.get('BOKEH_WORKERS', '1'))  # on ports BOKEH_PORT + i
 
     # migration
     MIGRATION_DIR = os.path.join(basedir, 'migrations')
@@ -78,6 +92,13 @@ class BaseConfig(object):
     MAIL_DEFAULT_SENDER = 'uDina admin <admin@udina.org>'
     MAIL_SUBJECT_PREFIX = '[uDina]'
 
+    # mail dispatcher (app/utils/email.py)
+    MAIL_WORKERS      = 2
+    MAIL_QUEUE_SIZE   = 100
+    MAIL_RETRIES      = 3
+    MAIL_RETRY_DELAY  = 1   # in seconds, doubled on each retry
+    MAIL_IDLE_TIMEOUT = 2   # in seconds, before a worker closes its connection
+
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration."""
@@ -91,6 +112,7 @@ class DevelopmentConfig(BaseConfig):
     TOKEN_EXPIRES_IN               = 1 # in hours
     PERMANENT_SESSION_LIFETIME     = datetime.timedelta(minutes=20)
     REMEMBER_COOKIE_DURATION       = datetime.timedelta(minutes=20)
+    SESSION_REFRESH_WITHIN         = datetime.timedelta(minutes=5)
 
 
 class TestingConfig(BaseConfig):
@@ -100,6 +122,15 @@ class TestingConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = 4
     WTF_CSRF_ENABLED  = False
 
+    # local debugging SMTP server:
+    #   $ python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER        = os.environ.get('APP_MAIL_SERVER', 'localhost')
+    MAIL_PORT          = int(os.environ.get('APP_MAIL_PORT', 1025))
+    MAIL_USE_TLS       = False
+    MAIL_USE_SSL       = False
+    MAIL_SUPPRESS_SEND = False
+    MAIL_RETRY_DELAY   = 0.1
+
 
 class ProductionConfig(BaseConfig):
     """Production configuration."""
@@ -4,9 +4,11 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app, db, bcrypt
-from app.models import User
+from app.models import User, Device, Calibration, Measure
 
-import os
+from sqlalchemy import event
+
+import datetime, json, os, sys, time, uuid
 
 app.config.from_object(os.environ['APP_CONFIG'])
 
@@ -52,5 +54,242 @@ def create_admin():
     user.confirm(token)
 
 
+@manager.command
+def backfill_calibrations():
+    """Points each device to its latest calibration."""
+    latest = db.session.query(
+                Calibration.device_id,
+                Calibration.id
+            ).\
+            distinct(Calibration.device_id).\
+            order_by(Calibration.device_id, Calibration.created_on.desc()).\
+            subquery()
+
+    count = Device.query.\
+            filter(Device.id == latest.c.device_id).\
+            update({Device.current_calibration_id: latest.c.id}, synchronize_session=False)
+    db.session.commit()
+    print("%d devices updated." % count)
+
+
+def seed_explain_data(measures):
+    """Adds users, devices, calibrations and measures for explain()."""
+    now     = datetime.datetime.utcnow()
+    users   = [uuid.uuid4() for i in range(20)]
+    devices = [uuid.uuid4() for i in range(10)]
+
+    db.session.bulk_insert_mappings(User, [dict(
+        id            = _id,
+        username      = 'explain_%d' % i,
+        _password     = 'x',
+        firstname     = 'explain',
+        lastname      = 'explain',
+        email         = 'explain_%d@explain.org' % i,
+        using_devices = dict((str(_d), str(now)) for _d in devices[:5]),
+    ) for i, _id in enumerate(users)])
+
+    db.session.bulk_insert_mappings(Device, [dict(
+        id         = _id,
+        code       = 'explain_%d' % i,
+        created_by = users[0],
+    ) for i, _id in enumerate(devices)])
+
+    calibrations = [dict(
+        id         = uuid.uuid4(),
+        device_id  = devices[i % len(devices)],
+        data       = dict(linear=0, angular=1),
+        created_on = now - datetime.timedelta(hours=i),
+        created_by = users[i % len(users)],
+    ) for i in range(50 * len(devices))]
+    db.session.bulk_insert_mappings(Calibration, calibrations)
+
+    for _d in devices:
+        Device.query.filter_by(id=_d).update(dict(current_calibration_id=[
+            _c['id'] for _c in calibrations if _c['device_id'] == _d][0]))
+
+    for start in range(0, measures, 5000):
+        db.session.bulk_insert_mappings(Measure, [dict(
+            id             = uuid.uuid4(),
+            device_id      = calibrations[i % len(calibrations)]['device_id'],
+            calibration_id = calibrations[i % len(calibrations)]['id'],
+            samples        = b'\x00' * 64,
+            created_on     = now - datetime.timedelta(minutes=i),
+            created_by     = users[i % len(users)],
+        ) for i in range(start, min(start + 5000, measures))])
+
+    return User.query.get(users[0])
+
+
+def seq_scans_of(plan):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for _plan in plan.get('Plans', []):
+        for relation in seq_scans_of(_plan):
+            yield relation
+
+
+@manager.option('-m', '--measures', dest='measures', type=int, default=20000)
+def explain(measures):
+    """Runs EXPLAIN ANALYZE on the hot queries against a seeded dataset,
+    which is rolled back. Fails if a query needs a sequential scan."""
+    from app._bokeh import views
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    failures = 0
+    try:
+        user = seed_explain_data(measures)
+        page = views.get_measurement_from(user)
+        db.session.execute("ANALYZE users; ANALYZE devices; ANALYZE calibrations; ANALYZE measures;")
+
+        # with sequential scans priced out, one shows up only if there is
+        # no usable index, whatever the tables' size
+        db.session.execute("SET LOCAL enable_seqscan = off")
+
+        hot_queries = [
+            ("get_devices_from",            lambda: views.get_devices_from(user)),
+            ("get_calibrations_from",       lambda: views.get_calibrations_from(user)),
+            ("get_measurement_from",        lambda: views.get_measurement_from(user)),
+            ("get_measurement_from before", lambda: views.get_measurement_from(user, before=(page[-1].m_created, page[-1].id))),
+            ("get_measurement_from device", lambda: views.get_measurement_from(user, device='explain_1')),
+            ("get_measure_from",            lambda: views.get_measure_from(user, page[0].id)),
+        ]
+
+        cursor = db.session.connection().connection.cursor()
+        for name, query in hot_queries:
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                query()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            for statement, parameters in statements:
+                cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + statement, parameters)
+                result = cursor.fetchone()[0]
+                result = json.loads(result) if isinstance(result, str) else result
+
+                seq_scans = list(seq_scans_of(result[0]['Plan']))
+                failures += len(seq_scans)
+                print("%-30s %8.3f ms  %s" % (name, result[0]['Execution Time'],
+                      "SEQ SCAN on " + ", ".join(seq_scans) if seq_scans else "ok"))
+    finally:
+        db.session.rollback()
+
+    if failures:
+        sys.exit("%d sequential scans found." % failures)
+
+
+def seed_bench_data(devices):
+    """Adds a user with calibrated devices for bench()."""
+    now     = datetime.datetime.utcnow()
+    user_id = uuid.uuid4()
+    prefix  = 'bench_%s' % user_id.hex[:8]
+    ids     = [uuid.uuid4() for i in range(devices)]
+
+    db.session.bulk_insert_mappings(User, [dict(
+        id            = user_id,
+        username      = prefix,
+        _password     = 'x',
+        firstname     = 'bench',
+        lastname      = 'bench',
+        email         = '%s@bench.org' % prefix,
+        _confirmed    = True,
+        using_devices = dict((str(_d), str(now)) for _d in ids),
+    )])
+
+    db.session.bulk_insert_mappings(Device, [dict(
+        id         = _id,
+        code       = '%s_%d' % (prefix, i),
+        created_by = user_id,
+    ) for i, _id in enumerate(ids)])
+
+    calibrations = [dict(
+        id         = uuid.uuid4(),
+        device_id  = _d,
+        data       = dict(linear=0, angular=0.01),
+        created_by = user_id,
+    ) for _d in ids]
+    db.session.bulk_insert_mappings(Calibration, calibrations)
+
+    for _c in calibrations:
+        Device.query.filter_by(id=_c['device_id']).update(dict(current_calibration_id=_c['id']))
+
+    db.session.commit()
+    return user_id, ids
+
+
+def delete_bench_data(user_id, ids):
+    Device.query.filter(Device.id.in_(ids)).\
+        update({Device.current_calibration_id: None}, synchronize_session=False)
+    Calibration.query.filter(Calibration.device_id.in_(ids)).delete(synchronize_session=False)
+    Device.query.filter(Device.id.in_(ids)).delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+
+@manager.option('-d', '--devices', dest='devices', type=int, default=5)
+@manager.option('-s', '--seconds', dest='seconds', type=float, default=10.)
+@manager.option('-b', '--batch', dest='batch', type=int, default=50)
+@manager.option('--broker', dest='broker', default=None)
+def bench(devices, seconds, batch, broker):
+    """Streams emulated devices to headless '/_measure' sessions and prints
+    their latency, dropped samples and CPU/memory use (see
+    app/_bokeh/bench.py). The seeded user and devices are deleted."""
+    # the sessions call the API in-process, the bench needs no Flask server
+    os.environ.setdefault('BOKEH_API_MODE', 'local')
+    from app._bokeh import bench as _bench
+
+    user_id, ids = seed_bench_data(devices)
+    try:
+        token = User.query.get(user_id).generate_token(
+            expiration = app.config['TOKEN_EXPIRES_IN'],
+            token_type = 'bokeh',
+        )
+        print(_bench.Bench(token, seconds=seconds, batch=batch, broker=broker).run())
+    finally:
+        db.session.rollback()
+        delete_bench_data(user_id, ids)
+
+
+@manager.option('-c', '--case', dest='cases', action='append', default=None)
+@manager.option('-t', '--tolerance', dest='tolerance', type=float, default=0.25)
+@manager.option('-q', '--quick', dest='quick', action='store_true', default=False)
+@manager.option('--save', dest='save', action='store_true', default=False)
+def microbench(cases, tolerance, quick, save):
+    """Times the hot paths and compares them with this machine's baseline,
+    if one was recorded (see app/_bokeh/microbench.py). Fails if a case is
+    more than 'tolerance' slower. With --save, the timings become the
+    baseline."""
+    from app._bokeh import microbench as _microbench
+
+    results  = _microbench.run(cases, quick)
+    baseline = _microbench.load_baseline()
+    lines, regressed = _microbench.compare(results, baseline, tolerance)
+    print("\n".join(lines))
+
+    if baseline is None and not save:
+        print("No baseline in %s: run with --save to record one." % _microbench.BASELINE)
+    if save:
+        _microbench.save_baseline(results)
+        print("Baseline saved to %s." % _microbench.BASELINE)
+    elif regressed:
+        sys.exit("%d cases slower than the baseline: %s" % (len(regressed), ", ".join(regressed)))
+
+
+@manager.command
+def calibrate_bcrypt(target_ms=250):
+    """Prints the bcrypt rounds that hash in about target_ms on this machine,
+    to set as BCRYPT_LOG_ROUNDS in the config."""
+    from app import hasher
+
+    rounds = hasher.calibrate_rounds(float(target_ms))
+    start  = time.time()
+    hasher.hash('calibration', rounds)
+    print("BCRYPT_LOG_ROUNDS = %d  # %.0f ms" % (rounds, (time.time() - start) * 1e3))
+
+
 if __name__ == '__main__':
     manager.run()
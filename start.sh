@@ -11,6 +11,7 @@ function clean_env() {
 
     unset BOKEH_LOG_LEVEL
     unset BOKEH_PY_LOG_LEVEL
+    unset BOKEH_WORKERS
 
     unset APP_DB_USERNAME
     unset APP_DB_PASSWORD
@@ -38,6 +39,7 @@ function init_env_vars() {
     # export APP_CONFIG="config.ProductionConfig"
     # export BOKEH_LOG_LEVEL=info
     # export BOKEH_PY_LOG_LEVEL=none
+    # export BOKEH_WORKERS=4            # bokeh processes, on ports 5006 to 5009
 }
 
 this_script=${BASH_SOURCE[0]}
@@ -74,6 +76,7 @@ if [[ -n $1 ]]; then
             fi
             python manage.py db migrate
             python manage.py db upgrade
+            python manage.py backfill_calibrations
             ;;
         --upgrade-flask)
             source $this_script --upgrade-db